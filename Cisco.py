@@ -20,7 +20,10 @@
 
 from telnetlib import Telnet
 from sets import Set
-import multiprocessing
+from topology import TopologyCache
+from command_statistics import CommandStatistics
+import threading
+import Queue
 import re
 import time
 import json
@@ -29,6 +32,60 @@ import socket
 import os
 import pprint
 
+# Short names of interface types, keyed by every lowercase spelling IOS uses for them (show run, CDP, ...)
+interface_types = {
+    "tengigabitethernet": "Te", "ten": "Te", "te": "Te",
+    "gigabitethernet": "Gi", "gig": "Gi", "gi": "Gi",
+    "fastethernet": "Fa", "fas": "Fa", "fa": "Fa"}
+interface_name_regex = re.compile(r"\s*([A-Za-z]+)\s*([0-9][0-9/.:]*)\s*$")
+interface_names = {}  # interface name as seen -> canonical interface name
+
+
+def normalize_interface_name(interface_name):
+    """ Return the canonical (short) form of an interface name, e.g. Gi1/0/1 for GigabitEthernet1/0/1 or
+        "Gig 1/0/1". Names of unknown interface types are returned unchanged. """
+    try:
+        return interface_names[interface_name]
+    except KeyError:
+        pass
+    canonical = interface_name
+    match = interface_name_regex.match(interface_name)
+    if match is not None:
+        interface_type = interface_types.get(match.group(1).lower())
+        if interface_type is not None:
+            canonical = interface_type + match.group(2)
+    interface_names[interface_name] = canonical
+    return canonical
+
+
+class CommandParser(object):
+    """ This class holds a show command and the regex for its output, compiled once """
+
+    # Fields holding an interface name, which are normalized with normalize_interface_name
+    interface_fields = ("interface", "port", "portid")
+
+    def __init__(self, command, regex):
+        self.command = command
+        self.regex = re.compile(regex)
+        self.normalized_fields = [field for field in self.regex.groupindex if field in self.interface_fields]
+
+    def dicts(self, output, hostname):
+        """ Parse output into a list of dicts, one per match """
+        result_list = []
+        append = result_list.append
+        normalized_fields = self.normalized_fields
+        for match in self.regex.finditer(output):
+            result = match.groupdict()
+            for field in normalized_fields:
+                value = result[field]
+                if value is not None:
+                    # Most names have been seen before, skip the call for those
+                    result[field] = interface_names.get(value) or normalize_interface_name(value)
+            result['hostname'] = hostname
+            append(result)
+        return result_list
+
+
 class CiscoTelnetSession(object):
     """ This class provides the interface to a Cisco router/switch over Telnet """
 
@@ -56,24 +113,88 @@ class CiscoTelnetSession(object):
     regex_patchid = '(?P<patchid>[a-z0-9_]+(\-|\.)[a-z0-9]+(\-|\.)[0-9]+[a-z]?)'
     regex_vlanconfig = 'switchport access vlan ' + regex_vlanid.replace("vlanid", "vlanconfig")
     regex_monitor_session = 'monitor session (?P<monitor_session>[0-9]+)'
-    regex_monitor_srcdst = '(?P<src_dst>(source|destination))\s*(remote|interface)\s*'
+    regex_monitor_srcdst = '(?P<src_dst>(source|destination))\s*((remote|interface)\s*)?'
     regex_fan = "FAN is (?P<FAN>[A-Z]+)"
     regex_temperature = "TEMPERATURE is (?P<TEMPSTATUS>[A-Z]+)"
     regex_temperature_value = "(Temperature Value: (?P<TEMP>[0-9]+) Degree Celsius)?"
     regex_temperature_state = "(Temperature State: (?P<TEMPCOLOR>[A-Z]+))?"
     regex_power_state = "Built-in[\s+] (?P<PWR>[A-Z]+)"
 
+    # Parsers for the output of show commands, keyed by method name
+    parsers = {}
+    for name, command, regex_parts in [
+            ("show_mac_address_table", "show mac address-table",
+             [regex_whitespace, regex_vlanid, regex_whitespace, regex_macaddress, regex_whitespace,
+              regex_macaddress_type, regex_whitespace, regex_port]),
+            ("show_vlan", "show vlan brief",
+             [regex_vlanid, regex_whitespace, regex_vlanname, regex_whitespace, regex_vlanstatus, regex_whitespace]),
+            ("show_neighbors", "show cdp neighbors",
+             [regex_deviceid, regex_whitespace, regex_interface, regex_whitespace, regex_holdtime, regex_whitespace,
+              regex_capabilities, regex_whitespace, regex_platform, regex_optionalwhitespace, regex_portid]),
+            ("show_health", "show env all",
+             [regex_fan, regex_whitespace, regex_temperature, regex_whitespace, regex_temperature_value,
+              regex_whitespace, regex_temperature_state]),
+            ("show_interface_vlan", "show interface status",
+             [regex_interface, regex_whitespace, regex_patchid, regex_whitespace, regex_string, regex_whitespace,
+              regex_vlanid]),
+            ("show_arp", "show arp",
+             [regex_protocol, regex_whitespace, regex_ip, regex_whitespace, regex_age, regex_whitespace,
+              regex_macaddress, regex_whitespace, regex_arptype, regex_whitespace, regex_vlanname]),
+            ("show_lldp_neighbors", "show lldp neighbors",
+             [regex_lldp_deviceid, regex_whitespace, regex_interface, regex_whitespace, regex_holdtime,
+              regex_whitespace, regex_capabilities, regex_whitespace, regex_portid]),
+            ("get_interface_vlan_setting", "show run | inc (interface)|switchport access vlan",  # inc can handle regex!
+             ["interface ", regex_interface, regex_whitespace, regex_vlanconfig]),
+            ("show_span", "show run | inc monitor session",
+             [regex_monitor_session, ' ', regex_monitor_srcdst, regex_interface]),
+            ("show_run_interface", "show run interface",
+             ["(?m)^interface ", regex_interface, "(?:[^!]*?", regex_vlanconfig, ")?"])]:  # Not the echoed command
+        parsers[name] = CommandParser(command, "".join(regex_parts))
+    del name, command, regex_parts
+
+    # The telnetlib.Telnet compatible class used to connect, fake_ios.ReplayTelnet replays recorded sessions
+    transport = Telnet
     newline = "\n"
     character_time_spacing_seconds = 0.1
     line_time_spacing_seconds = 0.1
+    echo_timeout_seconds = 2
+    # Hosts that are known to drop input unless it is written character by character
+    character_paced_hosts = set()
+    # Lines not echoed per host, a host is character paced for all sessions after this many
+    echo_failures = {}
+    echo_failures_before_host_pacing = 3
+    erase_line = "\x15"  # Ctrl-U, makes IOS forget the part of the line typed so far
+    # Any prompt at the end of the output: hostname, optional config mode, # or >
+    regex_any_prompt = re.compile(r"([^\s#>()]+)(\([a-z0-9-]+\))?([#>])\s*$")
+    # Everything up to and including the last newline
+    regex_complete_lines = re.compile(r"(?s).*\n")
+    # Seconds to wait for the prompt, for commands known to take longer than response_timeout. Reads return as
+    # soon as the prompt arrives, so these only matter for devices that don't answer.
+    command_timeouts = [
+        ("copy ", 120),
+        ("write mem", 120),
+        ("show tech", 300),
+        ("show run", 60),
+        ("show mac address-table", 60),
+        ("show env", 30)]
+
+    @classmethod
+    def prompt_regex_for(cls, name):
+        """ Compile the regex matching the normal and config prompts of the device called name """
+        return re.compile(re.escape(name) + r"(\([a-z0-9-]+\))?#\s*$")
+
+    @classmethod
+    def timeout_for(cls, command, default):
+        """ Look up the timeout of command in command_timeouts """
+        for prefix, timeout in cls.command_timeouts:
+            if command.startswith(prefix):
+                return timeout
+        return default
 
     @staticmethod
     def fix_interfacename(interface_name):
         """ Fix common changes in interface naming. GigabitEthernet vs Gi """
-        ret = interface_name.replace("GigabitEthernet", "Gi")
-        ret = ret.replace("FastEthernet", "Fa")
-        ret = ret.replace("TenGigabitEthernet", "Te")
-        return ret
+        return normalize_interface_name(interface_name)
 
     def __init__(self):
         # Info for connecting and telnet
@@ -83,15 +204,53 @@ class CiscoTelnetSession(object):
         self.password = ""
         self.session = 0
         self.prompt = "#"
+        self.prompt_regex = self.prompt_regex_for("")
         self.response_timeout = 15
+        self.echoed_output = ""
+        self.read_timed_out = False  # Whether a read gave up waiting for the prompt, and output may still arrive
+        self.character_paced = False  # Whether this session lost input, and writes character by character since
+        self.statistics = None  # CommandStatistics to record the timing of commands in, if any
+        self.command_name = None  # Name the statistics of the current commands are recorded under, if not the command
+        self.current_command = ""
 
     def __del__(self):
         # self.session.write("exit\n")
-        self.session.close()
+        if self.session:
+            self.session.close()
 
     def write_command(self, commandstr):
-        """ Write a command to the peer """
-#		self.session.write(commandstr)
+        """ Write a command to the peer, one line at a time. Returns False if a line was not echoed, in which case
+            that line and the rest were written again per character. """
+        if self.character_paced or self.host in CiscoTelnetSession.character_paced_hosts:
+            return self.write_command_characters(commandstr)
+
+        lines = commandstr.split(self.newline)
+        for i, line in enumerate(lines[:-1]):
+            self.session.write(line + self.newline)
+            if line == "":
+                continue  # Empty lines give no echo
+            echo = self.session.read_until(line, self.echo_timeout_seconds)
+            self.echoed_output += echo
+            if not echo.endswith(line):
+                # The device did not echo the line back, so it may have dropped (part of) it. Erase what it got of
+                # the line and write it again with the rest, per character. Repeating a configuration line is
+                # harmless, skipping one (e.g. an interface line) is not.
+                sys.stderr.write("write_command: no echo from %s, falling back to character pacing\n" % self.host)
+                self.character_paced = True
+                failures = CiscoTelnetSession.echo_failures.get(self.host, 0) + 1
+                CiscoTelnetSession.echo_failures[self.host] = failures
+                if failures >= self.echo_failures_before_host_pacing:
+                    CiscoTelnetSession.character_paced_hosts.add(self.host)
+                self.write_command_characters(self.erase_line + self.newline.join(lines[i:]))
+                return False
+        if lines[-1] != "":
+            self.session.write(lines[-1])
+        return True
+
+    def write_command_characters(self, commandstr):
+        """ Write a command to the peer, one character at a time. Then wait for the echo of every line, like
+            write_command does, so the read that follows doesn't stop at the prompt after one of the earlier lines
+            of a device lagging behind. Returns whether all lines were echoed. """
         commandstr_len = len(commandstr)
         for i in range(0, commandstr_len):
             self.session.write(commandstr[i])
@@ -99,38 +258,94 @@ class CiscoTelnetSession(object):
             if commandstr[i] == '\n':
                 time.sleep(self.line_time_spacing_seconds)
 
+        for line in commandstr.replace(self.erase_line, "").split(self.newline):
+            if line == "":
+                continue  # Empty lines give no echo
+            echo = self.session.read_until(line, self.echo_timeout_seconds)
+            self.echoed_output += echo
+            if not echo.endswith(line):
+                return False
+        return True
+
+    def read_until_prompt(self, timeout):
+        """ Read until a normal or config prompt arrives, return the output without the prompt. Returns whatever
+            arrived when timing out. """
+        return "".join(self.read_lines_until_prompt(timeout))
+
+    def read_lines_until_prompt(self, timeout):
+        """ Yield the output as it arrives, in pieces of complete lines, until a normal or config prompt arrives.
+            The last piece is the output before the prompt, or whatever arrived when timing out. Complete lines are
+            taken as they arrive, so the prompt is only searched for in the last line instead of in all output
+            after every read. """
+        deadline = time.time() + timeout
+        while True:
+            index, match, text = self.session.expect([self.prompt_regex, self.regex_complete_lines],
+                                                     max(deadline - time.time(), 0))
+            if index == 0:
+                yield text[:match.start()]
+                return
+            yield text
+            if index == -1:
+                self.read_timed_out = True
+                return
+
+    def record(self, phase, started, command=None, **counters):
+        """ Record the time since started, and counters, for phase of the current command in statistics """
+        if self.statistics is None:
+            return
+        if command is None:
+            command = self.command_name or self.current_command
+        self.statistics.record(self.host, command, phase, time.time() - started, **counters)
+
     def execute_command_lowlevel(self, command, timeout=None):
         """ Execute a command and return the result """
+        commandstr = str(command) + self.newline  # Arguments from the topology cache are unicode, telnetlib wants bytes
         if timeout is None:
-            timeout = self.response_timeout
-        commandstr = command + self.newline  # .strip() + self.newline
-        self.write_command(commandstr)
-        output = self.session.read_until(self.prompt, timeout)
-        ret = output[:-len(self.prompt)]
+            timeout = self.timeout_for(commandstr.strip(), self.response_timeout)
+        self.current_command = commandstr.split(self.newline, 1)[0]
+        self.echoed_output = ""
+        started = time.time()
+        echoed = self.write_command(commandstr)
+        self.record("write", started, bytes_sent=len(commandstr), timeouts=int(not echoed))
+        started = time.time()
+        output = self.read_until_prompt(timeout)
+        self.record("read", started, bytes_received=len(self.echoed_output) + len(output),
+                    timeouts=int(time.time() - started >= timeout))  # Only a missing prompt takes the full timeout
+        ret = self.echoed_output + output
         # print "%s: '%s'" % (command, ret)
         return ret
 
     def execute_command(self, command, timeout=None):
         """ Execute a command on the Cisco switch """
         retries_remaining = 3
+        started = time.time()
 
+        ret = None
         while retries_remaining > 0:
             try:
-                return self.execute_command_lowlevel(command, timeout)
+                ret = self.execute_command_lowlevel(command, timeout)
+                break
             except EOFError:
                 retries_remaining = retries_remaining - 1
                 print "Got EOFError, reconnecting..."
                 self.connect_and_login()
+        self.record("execute", started, self.command_name or str(command).split(self.newline, 1)[0],
+                    retries=3 - retries_remaining)
+        return ret
 
     def connect_and_login(self):
         """ Establish a Telnet connection and perform a login """
-        self.session = Telnet()
+        started = time.time()
+        self.session = self.transport()
         try:
             self.session.open(self.host, self.port, self.response_timeout)
         except socket.timeout:
+            self.record("login", started, "login", timeouts=1)
             return False
 
-        if not self.login(self.username, self.password):
+        logged_in = self.login(self.username, self.password)
+        self.record("login", started, "login")
+        if not logged_in:
             return False
 
         try:
@@ -148,19 +363,25 @@ class CiscoTelnetSession(object):
             self.session.write(username + self.newline)
             self.session.read_until("Password:", self.response_timeout)
             self.session.write(password + self.newline)
-            pass_response = self.session.read_until(self.prompt, self.response_timeout)
-            if self.prompt not in pass_response:
-                return False
+            _, match, _ = self.session.expect([self.regex_any_prompt], self.response_timeout)
+            if match is None or match.group(3) != "#":
+                return False  # Login failed, or not in privileged mode
+            self.learn_prompt(match.group(1))
         else:
             self.session.close()
             return False
         return True
 
+    def learn_prompt(self, name):
+        """ Use the hostname the device shows in its prompt, which can differ from the DNS name """
+        self.prompt = name + "#"
+        self.prompt_regex = self.prompt_regex_for(name)
+
     def open(self, host, port, username, password):
         """ Open a connection to a Cisco router/switch """
         self.host = str(host)  # In case we receive a Unicode string
         self.port = port
-        self.prompt = self.host[:self.host.find(".")] + "#"
+        self.learn_prompt(self.host[:self.host.find(".")])  # Until the device shows its prompt
         self.username = username
         self.password = password
         connect_login_result = self.connect_and_login()
@@ -170,9 +391,21 @@ class CiscoTelnetSession(object):
         """ Close the connection to the Cisco router/switch """
         self.execute_command("exit")
 
+    def is_alive(self, timeout=None):
+        """ Check whether the session still answers with a prompt """
+        if timeout is None:
+            timeout = self.echo_timeout_seconds
+        try:
+            self.session.read_very_eager()  # Discard anything left over from a previous command
+            self.session.write(self.newline)
+            _, match, _ = self.session.expect([self.prompt_regex], timeout)
+        except (EOFError, socket.error, AttributeError):
+            return False
+        return match is not None
+
     def filter_output(self, output, regex):
         """ Filter output from a command """
-        result = {}
+        started = time.time()
         result_list = []
         if isinstance(output, str):
             lines = [output]
@@ -180,16 +413,12 @@ class CiscoTelnetSession(object):
             lines = output
 
         for line in lines:
-            iterator = re.finditer(regex, line)
-            try:
-                while True:
-                    cur = iterator.next()
-                    result = cur.groupdict()
-                    result['hostname'] = self.host
-                    result_list.append(result)
-            except StopIteration:
-                pass
+            for cur in re.finditer(regex, line):
+                result = cur.groupdict()
+                result['hostname'] = self.host
+                result_list.append(result)
 
+        self.record("parse", started)
         return result_list
 
     def command_filter(self, command, regex, timeout=None):
@@ -198,65 +427,123 @@ class CiscoTelnetSession(object):
         result_list = self.filter_output(output, regex)
         return result_list
 
+    def command_parse(self, name, timeout=None, arguments=None):
+        """ Execute the command registered in parsers under name, and parse its output into dicts. Arguments
+            narrowing down the output (e.g. "address 0011.2233.4455") are appended to the command. """
+        parser = self.parsers[name]
+        command = parser.command
+        if arguments is not None:
+            command += " " + arguments
+        output = self.execute_command(command, timeout)
+        return self.parse_dicts(parser, output)
+
+    def parse_dicts(self, parser, output):
+        """ Parse output into dicts with parser, recording the time it takes """
+        started = time.time()
+        result_list = parser.dicts(output, self.host)
+        self.record("parse", started)
+        return result_list
+
+    def command_parse_row(self, name, arguments, timeout=None):
+        """ Like command_parse with arguments, for commands about a single item. Returns the first dict, or None. """
+        result_list = self.command_parse(name, timeout, arguments)
+        if len(result_list) == 0:
+            return None
+        return result_list[0]
+
+    def command_stream(self, name, timeout=None, arguments=None):
+        """ Like command_parse, but yield the dicts while the output arrives, instead of reading all output before
+            parsing it. Only for commands with one row per line of output. Unlike execute_command, this doesn't
+            reconnect on EOFError. """
+        parser = self.parsers[name]
+        command = parser.command
+        if arguments is not None:
+            command += " " + arguments
+        commandstr = command + self.newline
+        if timeout is None:
+            timeout = self.timeout_for(command, self.response_timeout)
+        self.current_command = command
+        self.echoed_output = ""
+        started = time.time()
+        echoed = self.write_command(commandstr)
+        self.record("write", started, bytes_sent=len(commandstr), timeouts=int(not echoed))
+
+        started = time.time()
+        received = len(self.echoed_output)
+        parse_seconds = 0.0
+        try:
+            for text in self.read_lines_until_prompt(timeout):
+                received += len(text)
+                parse_started = time.time()
+                rows = parser.dicts(text, self.host)
+                parse_seconds += time.time() - parse_started
+                for row in rows:
+                    yield row
+        finally:
+            # Recorded when the caller is done, stopping early included. The read includes the time the caller
+            # spent on the rows.
+            self.record("read", started, bytes_received=received,
+                        timeouts=int(time.time() - started >= timeout))
+            self.record("parse", time.time() - parse_seconds)  # Only the time spent parsing
+
     def show_mac_address_table(self):
         """ Get a list of mac addresses known to the device, with associated port, type and vlanid """
-        command = "show mac address-table"
-        regex = CiscoTelnetSession.regex_whitespace + \
-            CiscoTelnetSession.regex_vlanid + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_macaddress + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_macaddress_type + \
-            CiscoTelnetSession.regex_whitespace + CiscoTelnetSession.regex_port
-        return self.command_filter(command, regex)
+        return self.command_parse("show_mac_address_table")
+
+    def stream_mac_address_table(self):
+        """ Yield the mac address table entries as they arrive, like show_mac_address_table """
+        return self.command_stream("show_mac_address_table")
+
+    def show_mac_address_table_address(self, macaddress):
+        """ Get the mac address table entries of a single mac address, like show_mac_address_table """
+        return self.command_parse("show_mac_address_table", arguments="address " + macaddress)
+
+    def show_mac_address_table_interface(self, interface):
+        """ Get the mac address table entries of a single interface, like show_mac_address_table """
+        return self.command_parse("show_mac_address_table", arguments="interface " + interface)
+
+    def show_mac_address_table_vlan(self, vlanid):
+        """ Get the mac address table entries of a single VLAN, like show_mac_address_table """
+        return self.command_parse("show_mac_address_table", arguments="vlan " + str(vlanid))
 
     def show_vlan(self):
         """ Return a list of VLANs,status and assigned ports """
-        command = "show vlan brief"
-        regex = CiscoTelnetSession.regex_vlanid + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_vlanname + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_vlanstatus + CiscoTelnetSession.regex_whitespace
-#		regex += CiscoTelnetSession.regex_ports
-        return self.command_filter(command, regex)
+        return self.command_parse("show_vlan")
 
     def show_neighbors(self):
         """ Return a list of Cisco Discovery Protocol neighbors """
-        command = "show cdp neighbors"
-        regex = CiscoTelnetSession.regex_deviceid + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_interface + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_holdtime + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_capabilities + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_platform + CiscoTelnetSession.regex_optionalwhitespace
-        regex += CiscoTelnetSession.regex_portid
-        ret = self.command_filter(command, regex)
+        ret = self.command_parse("show_neighbors")
         return ret
 
     def show_health(self):
-        command = "show env all"
-        regex = CiscoTelnetSession.regex_fan + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_temperature + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_temperature_value + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_temperature_state
-        ret = self.command_filter(command, regex)
+        ret = self.command_parse("show_health")
         return ret
 
     def show_interface_vlan(self):
         """ Return a list of ports and their VLAN assignment """
-        command = "show interface status"
-        regex = CiscoTelnetSession.regex_interface + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_patchid + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_string + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_vlanid
-        return self.command_filter(command, regex)
+        return self.command_parse("show_interface_vlan")
+
+    def show_interface_status(self, interface):
+        """ Get the status of a single interface, like a row of show_interface_vlan, or None """
+        output = self.execute_command("show interfaces " + interface + " status")
+        result_list = self.parse_dicts(self.parsers["show_interface_vlan"], output)
+        if len(result_list) == 0:
+            return None
+        return result_list[0]
+
+    def show_run_interface(self, interface):
+        """ Get the VLAN setting of a single interface, like a row of get_interface_vlan_setting, or None. The
+            vlanconfig is None for interfaces without an access VLAN. """
+        return self.command_parse_row("show_run_interface", interface)
+
+    def show_arp_ip(self, ip):
+        """ Get the ARP entry of a single IP, like show_arp """
+        output = self.execute_command("show ip arp " + ip)
+        return self.parse_dicts(self.parsers["show_arp"], output)
 
     def show_arp(self):
         """ Request the ARP table of the switch """
-        command = "show arp"
-        regex = CiscoTelnetSession.regex_protocol + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_ip + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_age + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_macaddress + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_arptype + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_vlanname
-        return self.command_filter(command, regex)
+        return self.command_parse("show_arp")
 
     def upload_file_tftp(self, src_filename, host, dest_filename):
         '''Upload a file through tftp'''
@@ -299,13 +586,7 @@ class CiscoTelnetSession(object):
 
     def show_lldp_neighbors(self):
         '''Show LLDP neighbors'''
-        command = "show lldp neighbors"
-        regex = CiscoTelnetSession.regex_lldp_deviceid + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_interface + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_holdtime + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_capabilities + CiscoTelnetSession.regex_whitespace
-        regex += CiscoTelnetSession.regex_portid
-        return self.command_filter(command, regex)
+        return self.command_parse("show_lldp_neighbors")
 
     def show_lldp_neighbor_detail(self, neighbor):
         '''Show details of an LLDP neighbor'''
@@ -392,6 +673,19 @@ class CiscoTelnetSession(object):
         output = self.execute_command(command)
         return output
 
+    def set_interfaces_vlans(self, interfaces_vlans):
+        '''Set the VLAN ID of a list of interfaces in a single config session. VLAN ID "trunk" sets trunk mode.'''
+        command = "config t" + self.newline
+        for interface in interfaces_vlans.iterkeys():
+            vlanid = interfaces_vlans[interface]
+            if vlanid == "trunk":
+                command += self.set_single_interface_trunk(interface)
+            else:
+                command += self.set_single_interface_vlan(interface, vlanid)
+        command += "end" + self.newline
+        output = self.execute_command(command)
+        return output
+
     def set_single_interface_trunk(self, interface):
         '''Produce the command to set a single interaface to mode trunk'''
         command = "interface " + interface + self.newline
@@ -413,24 +707,20 @@ class CiscoTelnetSession(object):
 
     def get_interface_vlan_setting(self):
         """ Get the vlan settings for all interfaces """
-        regex = "interface " + CiscoTelnetSession.regex_interface
-        regex += CiscoTelnetSession.regex_whitespace + CiscoTelnetSession.regex_vlanconfig
-        command = "show run | inc (interface)|switchport access vlan"  # inc can handle regex!
-        output = self.command_filter(command, regex)
+        output = self.command_parse("get_interface_vlan_setting")
         return output
 
     def get_interface_status_and_setting(self):
         """ Get both status and settings for all interfaces """
         port_status = self.show_interface_vlan()
         port_setting = self.get_interface_vlan_setting()
+        vlansettings = {}  # (hostname, interface) -> vlanconfig, interface names are normalized by the parsers
+        for setting in port_setting:
+            vlansettings.setdefault((setting["hostname"], setting["interface"]), setting["vlanconfig"])
         for port in port_status:
-            hostname = port["hostname"]
-            interface = port["interface"]
-            vlansetting = [x["vlanconfig"] for x in port_setting if x["hostname"] ==
-                           hostname and CiscoTelnetSession.fix_interfacename(x["interface"]) == interface]
             try:
-                port["vlanconfig"] = vlansetting[0]
-            except IndexError:
+                port["vlanconfig"] = vlansettings[(port["hostname"], port["interface"])]
+            except KeyError:
                 pass
         return port_status
 
@@ -449,101 +739,455 @@ class CiscoTelnetSession(object):
         return output
 
     def show_span(self):
-        """ Show the active SPAN sessions on this switch """
-        regex = CiscoTelnetSession.regex_monitor_session + ' '
-        regex += CiscoTelnetSession.regex_monitor_srcdst
-        regex += CiscoTelnetSession.regex_interface
-        command = "show run | inc monitor session"
-        output = self.command_filter(command, regex)
+        """ Show the active SPAN sessions on this switch. Sources can be interfaces, VLANs ("vlan 10") or
+            remote VLANs. Of a range or list of sources ("Gi1/0/1 - 3", "vlan 10,20") only the first is listed. """
+        output = self.command_parse("show_span")
         return output
 
 
+class SessionPool(object):
+    """ This class keeps logged in CiscoTelnetSessions, keyed by hostname, for reuse """
+
+    def __init__(self, port, username, password, max_sessions_per_device=1, idle_timeout=300, statistics=None):  # pylint: disable=too-many-arguments
+        self.port = port
+        self.username = username
+        self.password = password
+        self.statistics = statistics  # CommandStatistics the sessions record their commands in
+        self.max_sessions_per_device = max_sessions_per_device
+        self.idle_timeout = idle_timeout  # Close sessions that have been unused for this many seconds
+        self.health_check_after = 10  # Check sessions that have been unused for this many seconds
+        self.idle = {}  # hostname -> list of (session, last used time)
+        self.in_use = {}  # hostname -> number of sessions handed out
+        self.condition = threading.Condition()
+
+    def acquire(self, hostname):
+        """ Get a logged in session to hostname, or None if we can't connect """
+        with self.condition:
+            self.evict_idle()
+            while self.in_use.get(hostname, 0) >= self.max_sessions_per_device:
+                self.condition.wait()
+            self.in_use[hostname] = self.in_use.get(hostname, 0) + 1
+            idle = self.idle.get(hostname, [])
+            session, last_used = idle.pop() if idle else (None, 0)
+
+        if session is not None and time.time() - last_used > self.health_check_after and not session.is_alive():
+            session.session.close()
+            session = None
+
+        if session is None:
+            session = CiscoTelnetSession()
+            session.statistics = self.statistics
+            try:
+                opened = session.open(hostname, self.port, self.username, self.password)
+            except Exception:  # pylint: disable=broad-except
+                opened = False  # Refused, or hung up during the login (EOFError). Either way, free the slot.
+            if not opened:
+                self.release(hostname, session, False)
+                return None
+        return session
+
+    def release(self, hostname, session, reuse=True):
+        """ Hand a session obtained through acquire back to the pool """
+        if not reuse and session.session:
+            session.session.close()
+        with self.condition:
+            self.in_use[hostname] = self.in_use[hostname] - 1
+            if reuse:
+                self.idle.setdefault(hostname, []).append((session, time.time()))
+            self.condition.notify_all()
+
+    def evict_idle(self):
+        """ Close sessions that have been idle for too long. Call with the condition held. """
+        now = time.time()
+        for idle in self.idle.values():
+            for session, last_used in idle[:]:
+                if now - last_used > self.idle_timeout:
+                    session.session.close()
+                    idle.remove((session, last_used))
+
+    def close(self):
+        """ Close all idle sessions """
+        with self.condition:
+            for idle in self.idle.values():
+                for session, _ in idle:
+                    session.session.close()
+            self.idle = {}
+
+
+class ConnectionFailed(Exception):
+    """ Raised when a device can't be connected to or logged in on """
+    pass
+
+
+class WorkerPool(object):
+    """ Reusable worker threads executing submitted calls. Workers are started when all others are busy, up to
+        max_workers, and kept until the pool is closed. """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.tasks = Queue.Queue()
+        self.workers = []
+        self.idle = 0  # Workers waiting for a task
+        self.pending = 0  # Tasks not yet taken by a worker
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def submit(self, function, *args):
+        """ Call function(*args) on a worker thread """
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("WorkerPool is closed")
+            self.pending += 1
+            if self.pending > self.idle and len(self.workers) < self.max_workers:
+                worker = threading.Thread(target=self.work)
+                worker.daemon = True  # Don't keep the program alive for a device that doesn't answer
+                self.workers.append(worker)
+                worker.start()
+            self.tasks.put((function, args))
+
+    def work(self):
+        """ Main loop of a worker thread """
+        while True:
+            with self.lock:
+                self.idle += 1
+            task = self.tasks.get()
+            with self.lock:
+                self.idle -= 1
+                self.pending -= 1
+            if task is None:
+                return
+            function, args = task
+            try:
+                function(*args)
+            except Exception:  # pylint: disable=broad-except
+                sys.stderr.write("WorkerPool: uncaught exception in %s\n" % function.__name__)
+
+    def close(self, timeout=None):
+        """ Stop the workers once the submitted tasks are done, wait at most timeout seconds for them """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            workers = list(self.workers)
+            for _ in workers:
+                self.pending += 1
+                self.tasks.put(None)
+        deadline = None if timeout is None else time.time() + timeout
+        for worker in workers:
+            worker.join(None if deadline is None else max(deadline - time.time(), 0))  # timeout for all together
+
+
+class AsyncExecution(object):
+    """ This class holds the results of a command executing on a number of hosts in the background """
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.results = [None] * len(hosts)
+        self.errors = [None] * len(hosts)
+        self.remaining = len(hosts)
+        self.condition = threading.Condition()
+
+    def finish(self, index, result, error=None):
+        """ Store the result (or the exc_info of the error) for the index'th host """
+        with self.condition:
+            self.results[index] = result
+            self.errors[index] = error
+            self.remaining = self.remaining - 1
+            self.condition.notify_all()
+
+    def ready(self):
+        """ Return whether all hosts have finished """
+        return self.remaining == 0
+
+    def wait(self, timeout=None):
+        """ Wait until all hosts have finished, or timeout seconds have passed """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.remaining > 0:
+                if deadline is None:
+                    self.condition.wait(1)  # A timeout keeps the wait interruptible with ^C
+                elif deadline > time.time():
+                    self.condition.wait(deadline - time.time())
+                else:
+                    break
+        return self.ready()
+
+    def get(self):
+        """ Wait for all hosts and return their combined results, like CiscoSet.execute_on_all """
+        self.wait()
+        ret = []
+        for result, error in zip(self.results, self.errors):
+            if error is not None:
+                if issubclass(error[0], ConnectionFailed):
+                    continue  # Already reported, an unreachable device contributes nothing
+                raise error[0], error[1], error[2]
+            if isinstance(result, list):
+                ret.extend(result)
+            else:
+                ret.append(result)
+        return ret
+
+
 class CiscoSet(object):
     """ This class represents a set of Cisco switches, connected in a network """
 
-    def __init__(self, username, password, start_device, port):
+    def __init__(self, username, password, start_device, port, max_concurrency=100):  # pylint: disable=too-many-arguments
         self.username = username
         self.password = password
         self.start_device = start_device
         self.port = port
         self.seen = {start_device}
+        self.adjacency = []  # CDP neighbor relations: hostname, interface, deviceid, portid
         self.blacklist = []
+        self.statistics = CommandStatistics()
+        self.sessions = SessionPool(port, username, password, statistics=self.statistics)
+        self.cache = TopologyCache(self.get_serialize_filename())
+        self.workers = WorkerPool(max_concurrency)  # Grows with the number of devices queried at once
+
+    def close(self, timeout=None):
+        """ Stop the workers, then close all sessions kept open by this set and save the statistics of the run """
+        self.workers.close(timeout)
+        self.sessions.close()
+        self.save_statistics()
+
+    def get_statistics_filename(self, extension="json"):
+        """ Get the filename to save the command statistics of this set to """
+        filename = "statistics-%s.%s" % (self.start_device, extension)
+        return filename
+
+    def save_statistics(self, filename=None):
+        """ Save the command statistics of this set, as Prometheus text if filename ends in .prom and as json
+            otherwise """
+        if filename is None:
+            filename = self.get_statistics_filename()
+        self.statistics.save(filename)
 
     def get_serialize_filename(self):
         """ Get the filename to serialize this set to """
+        filename = "topology-%s.json" % self.start_device
+        return filename
+
+    def get_legacy_serialize_filename(self):
+        """ Get the filename older versions serialized this set to """
         filename = "discover-%s.json" % self.start_device
         return filename
 
     def load(self):
         """ Load from file """
-        filename = self.get_serialize_filename()
+        if self.cache.load():
+            self.seen = set(self.cache.seen) | self.seen
+            self.adjacency = self.cache.adjacency
+            return
+
+        # No (usable) topology cache, bootstrap from the hostnames saved by older versions
+        filename = self.get_legacy_serialize_filename()
         seen = self.seen
         try:
             with open(filename, "r") as fd:
                 json_contents = fd.read()
 
             json_decoded = json.loads(json_contents)
-            self.seen = set(json_decoded)
+            if isinstance(json_decoded, list):
+                # Files written before we saved the adjacency only hold the hostnames
+                json_decoded = {"seen": json_decoded, "adjacency": []}
+            self.seen = set(json_decoded["seen"])
+            self.adjacency = json_decoded["adjacency"]
         except IOError:
             # Doesn't matter, we'll create it on save
             pass
-        except ValueError:
+        except (ValueError, KeyError):
             # Restore backup of seen when we encounter problems during decoding
             self.seen = seen
 
     def save(self):
         """ Save to file """
-        filename = self.get_serialize_filename()
-        json_contents = json.dumps(list(self.seen))
-
-        with open(filename, "w+") as fd:
-            fd.write(json_contents)
+        self.cache.seen = list(self.seen)
+        self.cache.adjacency = self.adjacency
+        self.cache.save()
 
     def set_blacklist(self, blacklist):
         """ Don't connect to these hosts """
         self.blacklist = blacklist
 
     def discover_devices(self):
-        '''Discover all networking devices, using a depth-first search.'''
+        '''Discover all networking devices, using a breadth-first search that queries every device once.'''
         self.load()  # Attempt to bootstrap using a saved json file
 
-        last_count = 0
-        while last_count != len(self.seen):
-            last_count = len(self.seen)
-
-            outputs = self.execute_on_all(CiscoTelnetSession.show_neighbors)
+        finished = Queue.Queue()
+        done = lambda host, result, error: finished.put((host, result, error, False))
+        adjacency = []
+        pending = 0
+        frontier = [host for host in self.seen]
+        while True:
+            # Start on every newly found device right away, instead of waiting for a whole round
+            for host in frontier:
+                if host in self.blacklist:
+                    continue
+                if self.cache.is_stale(host, "show_neighbors"):
+                    self.execute_on_host_async(host, "show_neighbors", done)
+                else:
+                    finished.put((host, self.cache.get(host, "show_neighbors"), None, True))
+                pending = pending + 1
+            frontier = []
+            if pending == 0:
+                break
+
+            host, outputs, error, cached = finished.get()
+            pending = pending - 1
+            if error is not None:
+                if not issubclass(error[0], ConnectionFailed):  # Those have been reported already
+                    sys.stderr.write("discover_devices: show_neighbors failed on %s: %s\n" % (host, error[1]))
+                continue
+            if not cached:
+                self.cache.put(host, "show_neighbors", outputs)
 
             for output in outputs:
-                self.seen.add(output['deviceid'])
+                adjacency.append({"hostname": host, "interface": output["interface"],
+                                  "deviceid": output["deviceid"], "portid": output["portid"]})
+                if output["deviceid"] not in self.seen:
+                    self.seen.add(output["deviceid"])
+                    frontier.append(output["deviceid"])
 
-            print "Seen: " + pprint.pformat(self.seen)
+        self.adjacency = adjacency
+        print "Seen: " + pprint.pformat(self.seen)
 
         self.save()  # Save what we've found for the next time
 
     def execute_on_all(self, command, *args):
         """ Execute command on all devices """
-        cpu_count = 25  # multiprocessing.cpu_count()
+        return self.execute_on_all_async(command, *args).get()
+
+    def execute_on_all_cached(self, command, stream_command=None):
+        """ Like execute_on_all, but only execute command on the devices of which the cached result is stale """
+        hosts = [host for host in self.seen if host not in self.blacklist]
+        return self.execute_on_hosts_cached(hosts, command, stream_command)
+
+    def execute_on_hosts_cached(self, hosts, command, stream_command=None):
+        """ Get the results of command on hosts from the cache, refreshing only the stale entries. With
+            stream_command, a command yielding the rows of command (e.g. stream_mac_address_table for
+            show_mac_address_table), the stale entries are parsed while the output arrives, so the raw output of
+            a large table is never kept in full. """
         command_name = command.__name__
-        print "Process count %d" % cpu_count
-        pool = multiprocessing.Pool(processes=cpu_count)
-
-        results = [
-            pool.apply_async(
-                execute_on_device,
-                (host,
-                 self.port,
-                 self.username,
-                 self.password,
-                 command_name) +
-                args) for host in self.seen if host not in self.blacklist]
+        stale = self.cache.stale_hosts(hosts, command_name)
+        if len(stale) > 0:
+            if stream_command is not None:
+                self.refresh_streamed(stale, command_name, stream_command)
+            else:
+                for host, result, error in self.iter_on_hosts(stale, command):
+                    if error is None:
+                        self.cache.put(host, command_name, result)
+            self.save()
+
         ret = []
-        for res in results:
-            try:
-                ret = ret + res.get()
-            except TypeError:
-                ret = ret + [res.get()]
+        for host in hosts:
+            result = self.cache.get(host, command_name)
+            if isinstance(result, list):
+                ret.extend(result)
+            elif result is not None:
+                ret.append(result)
         return ret
 
+    def refresh_streamed(self, hosts, command_name, stream_command):
+        """ Store the rows stream_command yields on hosts in the cache as the result of command_name """
+        rows = dict((host, []) for host in hosts)
+        for host, row, error in self.stream_on_hosts(hosts, stream_command):
+            if row is not None:
+                rows[host].append(row)
+            elif error is None:
+                self.cache.put(host, command_name, rows.pop(host))
+            else:
+                del rows[host]  # Incomplete, keep the previous result
+
+    def iter_on_all(self, command, *args):
+        """ Execute command on all devices, see iter_on_hosts """
+        hosts = [host for host in self.seen if host not in self.blacklist]
+        return self.iter_on_hosts(hosts, command, *args)
+
+    def iter_on_hosts(self, hosts, command, *args):
+        """ Execute command on the given devices. Yields (host, result, error) for each device as soon as it
+            finishes, where error is None on success and the exc_info of the failure otherwise. """
+        finished = Queue.Queue()
+        done = lambda host, result, error: finished.put((host, result, error))
+        for host in hosts:
+            self.execute_on_host_async(host, command.__name__, done, *args)
+        for _ in hosts:
+            yield finished.get()
+
+    def iter_jobs(self, jobs):
+        """ Execute a list of (host, command, cached) jobs concurrently. Yields (host, command name, result, error)
+            for each job as soon as it finishes. Jobs with cached set are answered from the cache while their
+            result is fresh, and their new results are stored in the cache. """
+        finished = Queue.Queue()
+        refreshed = 0
+        for host, command, cached in jobs:
+            command_name = command.__name__
+            if cached and not self.cache.is_stale(host, command_name):
+                finished.put((host, command_name, cached, self.cache.get(host, command_name), None, False))
+                continue
+            done = lambda host, result, error, command_name=command_name, cached=cached: \
+                finished.put((host, command_name, cached, result, error, True))
+            self.execute_on_host_async(host, command_name, done)
+
+        for _ in jobs:
+            host, command_name, cached, result, error, live = finished.get()
+            if cached and live and error is None:
+                self.cache.put(host, command_name, result)
+                refreshed += 1
+            yield host, command_name, result, error
+        if refreshed > 0:
+            self.save()
+
+    def execute_on_all_async(self, command, *args):
+        """ Start executing command on all devices in the background, return an AsyncExecution """
+        hosts = [host for host in self.seen if host not in self.blacklist]
+        return self.execute_on_hosts_async(hosts, command, *args)
+
+    def execute_on_hosts_async(self, hosts, command, *args):
+        """ Start executing command on the given devices in the background, return an AsyncExecution """
+        execution = AsyncExecution(hosts)
+        for index, host in enumerate(hosts):
+            done = lambda host, result, error, index=index: execution.finish(index, result, error)
+            self.execute_on_host_async(host, command.__name__, done, *args)
+        return execution
+
+    def execute_on_host_async(self, host, command_name, done, *args):
+        """ Execute a command on host on a worker and call done(host, result, error) when finished """
+        self.workers.submit(self.execute_on_host, host, command_name, done, *args)
+
+    def stream_on_hosts(self, hosts, command, *args):
+        """ Execute a command yielding rows, like stream_mac_address_table, on the given devices. Yields
+            (host, row, None) for every row as soon as it is parsed, and then (host, None, error) once a device
+            is done, where error is None on success and the exc_info of the failure otherwise. """
+        finished = Queue.Queue()
+        for host in hosts:
+            self.workers.submit(self.stream_on_host, host, command.__name__, finished.put, *args)
+        remaining = len(hosts)
+        while remaining > 0:
+            host, row, error = finished.get()
+            if row is None:
+                remaining -= 1
+            yield host, row, error
+
+    def stream_on_host(self, host, command_name, put, *args):
+        """ Execute a command yielding rows on host, and put (host, row, None) for every row and
+            (host, None, error) at the end """
+        try:
+            for row in stream_on_pooled_device(self.sessions, host, command_name, *args):
+                put((host, row, None))
+        except Exception:  # pylint: disable=broad-except
+            put((host, None, sys.exc_info()))
+            return
+        put((host, None, None))
+
+    def execute_on_host(self, host, command_name, done, *args):
+        """ Execute a command on host, and report the result to done """
+        try:
+            result = execute_on_pooled_device(self.sessions, host, command_name, *args)
+        except Exception:  # pylint: disable=broad-except
+            done(host, None, sys.exc_info())
+            return
+        done(host, result, None)
+
 def uniq(seq):
 	"""Remove duplicates from list"""
 	s = Set(seq)
@@ -570,3 +1214,58 @@ def execute_on_device(hostname, port, username, password, command_name, *args):
     else:
         sys.stderr.write("execute_on_device: failed to connect to " + hostname + "\n")
     return ret
+
+
+# Commands that can leave the session in another mode or with other terminal settings (e.g. free-form commands
+# like "conf t" or "terminal length 24"), so the session is closed afterwards instead of handed to the next caller
+unpooled_commands = ("execute_command", "execute_command_lowlevel")
+
+
+def stream_on_pooled_device(sessions, hostname, command_name, *args):
+    """ Like execute_on_pooled_device, for commands yielding rows like stream_mac_address_table. The session is
+        held until all rows are consumed, or the caller stops early. Then the rest of the output is still on its
+        way, so the session is closed instead of handed to the next caller. """
+    device = sessions.acquire(hostname)
+    if device is None:
+        sys.stderr.write("stream_on_pooled_device: failed to connect to " + hostname + "\n")
+        raise ConnectionFailed(hostname)
+
+    healthy = False
+    device.command_name = command_name
+    device.read_timed_out = False
+    rows = getattr(device, command_name)(*args)
+    try:
+        for row in rows:
+            yield row
+        healthy = not device.read_timed_out
+    finally:
+        rows.close()  # Records the statistics of the read
+        device.command_name = None
+        sessions.release(hostname, device, healthy)
+
+
+def execute_on_pooled_device(sessions, hostname, command_name, *args):
+    """ Helper function for CiscoSet.execute_on_all, using a session from a SessionPool """
+    command = getattr(CiscoTelnetSession, command_name, None)
+    if command is None:
+        sys.stderr.write(
+            "execute_on_pooled_device: failed to look up function %s in CiscoTelnetSession class\n" %
+            command_name)
+        return None
+
+    device = sessions.acquire(hostname)
+    if device is None:
+        sys.stderr.write("execute_on_pooled_device: failed to connect to " + hostname + "\n")
+        raise ConnectionFailed(hostname)
+
+    healthy = False
+    device.command_name = command_name  # Record the statistics under the method instead of every command it runs
+    device.read_timed_out = False
+    try:
+        ret = command(device, *args)
+        # The rest of the output of a read that timed out would end up in the result of the next command
+        healthy = command_name not in unpooled_commands and not device.read_timed_out
+    finally:
+        device.command_name = None
+        sessions.release(hostname, device, healthy)
+    return ret
@@ -20,6 +20,7 @@
 
 import sys
 import re
+import bisect
 import webbrowser
 # import pprint
 
@@ -28,23 +29,18 @@ import portconfig
 from PyQt4.QtGui import QApplication, QMessageBox, QTreeWidgetItem, QComboBox, QCheckBox
 from PyQt4.QtGui import QPushButton, QPalette, QColor, QIcon, QLabel
 from PyQt4.QtGui import QTextBrowser, QVBoxLayout, QFrame
-from PyQt4.QtCore import QThread, pyqtSignal, QVariant, QSettings
+from PyQt4.QtGui import QStyledItemDelegate, QStyleOptionButton, QStyle
+from PyQt4.QtGui import QAbstractItemView
+from PyQt4.QtCore import QThread, pyqtSignal, QVariant, QSettings, Qt
+from PyQt4.QtCore import QAbstractItemModel, QModelIndex, QEvent
 import PyQt4.uic as uic
 import json
 import os.path
 import ctypes
 import os
-import multiprocessing
-from Cisco import CiscoTelnetSession
-
-
-def execute_custom(hostname, port, username, password, command):
-    print "Executing " + command + " on " + hostname
-    device = CiscoTelnetSession()
-    open_result = device.open(hostname, port, username, password)
-    ret = {}
-    ret[hostname] = device.execute_command(command)
-    return ret
+import Queue
+import traceback
+from Cisco import CiscoSet, CiscoTelnetSession, ConnectionFailed
 
 
 class WorkerThread(QThread):
@@ -60,11 +56,16 @@ class WorkerThread(QThread):
 
 
 class GetConfigurationThread(WorkerThread):
-    """ Get the network configuration in the background. Emits the "newData"
-        signal with patchports and vlans when done, then emits the "finished"
-        signal. """
+    """ Get the network configuration in the background. After discovering
+        the network, the vlans, patchports and health of all switches are
+        fetched concurrently. Emits the "newVlans" signal with the vlans of
+        the start switch, and the "newPorts" and "newHealth" signals with the
+        patchports and health of every switch as soon as it has answered.
+        Then emits the "finished" signal. """
 
-    newData = pyqtSignal(dict)
+    newVlans = pyqtSignal(list)
+    newPorts = pyqtSignal(list)
+    newHealth = pyqtSignal(list)
 
     def __init__(self, hostname, username, password):
         """ Initialisation. """
@@ -76,19 +77,35 @@ class GetConfigurationThread(WorkerThread):
     def run(self):
         """ Run this thread. """
 
-        data = {
-            'ports': portconfig.get_available_patchports(self._host, 23,
-                                                         self._user,
-                                                         self._pass),
-            'vlans': portconfig.get_available_vlans(self._host, 23,
-                                                    self._user,
-                                                    self._pass),
-            'health': portconfig.get_health_status(self._host, 23,
-                                                   self._user,
-                                                   self._pass)
-        }
-
-        self.newData.emit(data)
+        switchset = CiscoSet(self._user, self._pass, self._host,
+                             portconfig.telnet_port)
+        switchset.discover_devices()
+        portconfig.set_switchlist(switchset)
+
+        hosts = [host for host in switchset.seen
+                 if host not in switchset.blacklist]
+
+        jobs = [(self._host, CiscoTelnetSession.show_vlan, True)]
+        jobs += [(host, CiscoTelnetSession.get_interface_status_and_setting, True)
+                 for host in hosts]
+        jobs += [(host, CiscoTelnetSession.show_health, False)
+                 for host in hosts]
+
+        for host, command_name, result, error in switchset.iter_jobs(jobs):
+            if error is not None:
+                if not issubclass(error[0], ConnectionFailed):    # Already reported
+                    sys.stderr.write("%s on %s failed: %s\n" % (
+                        command_name, host,
+                        ''.join(traceback.format_exception_only(*error[:2])).strip()))
+                result = []
+
+            if command_name == "show_vlan":
+                self.newVlans.emit(result + [portconfig.dynamic_vlan,
+                                             portconfig.trunk_vlan])
+            elif command_name == "show_health":
+                self.newHealth.emit(result)
+            else:
+                self.newPorts.emit(result)
 
 
 class SetConfigurationThread(WorkerThread):
@@ -99,6 +116,7 @@ class SetConfigurationThread(WorkerThread):
         WorkerThread.__init__(self, username, password)
 
         self._jobs = []
+        self._results = {}
 
     def addJob(self, switch_host, switch_port, old_vlan_id, new_vlan_id):
         """ Add a job configuring <switch_port> on <switch_host> from
@@ -116,19 +134,90 @@ class SetConfigurationThread(WorkerThread):
 
         return len(self._jobs)
 
+    def succeeded(self, switch_host):
+        """ Return whether the jobs on <switch_host> were applied, after this
+            thread has finished. """
+
+        return self._results.get(switch_host, False)
+
     def run(self):
         """ Run this thread. """
 
-        for job in self._jobs:
-            portconfig.configure_patchid_raw(self._user, self._pass,
-                                             job['switch_host'],
-                                             job['switch_port'],
-                                             job['new_vlan_id'],
-                                             job['old_vlan_id'])
+        self._results = portconfig.configure_patchids_raw(self._user, self._pass,
+                                                          self._jobs)
 
         self._jobs = []
 
 
+class ConsoleThread(QThread):
+    """ Execute a custom command on a number of switches in the background.
+        Emits the "hostResult" signal with the hostname and the output of
+        every switch as soon as that switch has answered, then emits the
+        "finished" signal. """
+
+    hostResult = pyqtSignal(str, str)
+
+    def __init__(self, switchset, hosts, command, timeout):
+        """ Initialisation. Waits at most <timeout> seconds for the output of
+            <command> on each switch. """
+
+        QThread.__init__(self)
+
+        self._switchset = switchset
+        self._hosts = hosts
+        self._command = command
+        self._timeout = timeout
+        self._cancelled = False
+
+    def cancel(self):
+        """ Stop waiting for the switches that haven't answered yet, and skip
+            those that haven't been started on yet. """
+
+        self._cancelled = True
+
+    def _execute(self, host, done):
+        """ Execute the command on <host> on a worker of the switchset, unless
+            cancelled while waiting for a worker. """
+
+        if self._cancelled:
+            return
+
+        # The pool closes sessions used for execute_command afterwards, as the
+        # command may have changed their mode or terminal settings
+        self._switchset.execute_on_host(host, "execute_command", done,
+                                        self._command, self._timeout)
+
+    def run(self):
+        """ Run this thread. """
+
+        finished = Queue.Queue()
+        done = lambda host, result, error: finished.put((host, result, error))
+
+        for host in self._hosts:
+            self._switchset.workers.submit(self._execute, host, done)
+
+        remaining = set(self._hosts)
+
+        while remaining and not self._cancelled:
+            try:
+                host, result, error = finished.get(True, 0.2)
+            except Queue.Empty:
+                continue
+
+            remaining.discard(host)
+
+            if error is not None:
+                result = ''.join(traceback.format_exception_only(*error[:2]))
+            elif result is None:
+                result = "(no response)"
+
+            self.hostResult.emit(host, result)
+
+        # Results arriving after a cancel end up in the queue and are dropped
+        for host in remaining:
+            self.hostResult.emit(host, "(cancelled)")
+
+
 class MyComboBox(QComboBox):
     """ A subclass of the PyQt4 QComboBox that ignores mouse wheel events. """
 
@@ -182,6 +271,349 @@ class MyComboBox(QComboBox):
         return self.itemData(self.currentIndex())
 
 
+class PortTreeNode(object):
+    """ A node in the PortTreeModel: a segment of a patch id, or a patchport
+        when it is a leaf. """
+
+    def __init__(self, name, parent):
+        """ Initialisation. """
+
+        self.name = name
+        self.parent = parent
+        self.children = []
+        self.child_names = []   # Sorted, parallel to children
+        self.port = None        # The patchport, for leaves
+        self.new_vlan = None    # The vlan selected by the user, for leaves
+
+    def row(self):
+        """ Return the row of this node below its parent. """
+
+        return bisect.bisect_left(self.parent.child_names, self.name)
+
+    def changed(self):
+        """ Return whether the user selected another vlan for this port. """
+
+        return self.port is not None and self.new_vlan is not None and \
+            str(self.new_vlan) != str(self.port['vlanid'])
+
+
+class PortTreeModel(QAbstractItemModel):
+    """ A tree of patchports, keyed by the segments of their patch ids. Ports
+        are added incrementally, keeping every level sorted. Emits the
+        "changeCount" signal with the number of ports that have another vlan
+        selected whenever that number changes. """
+
+    HEADERS = ["Port", "Switch", "Switch port", "Actual", "VLAN", "Submit"]
+
+    changeCount = pyqtSignal(int)
+
+    def __init__(self, parent=None):
+        """ Initialisation. """
+
+        QAbstractItemModel.__init__(self, parent)
+
+        self._root = PortTreeNode(None, None)
+        self._labels = {}       # vlan -> label
+        self._label_list = []   # [(vlan, label)], as used by MyComboBox
+        self._changes = set()   # The nodes with another vlan selected
+
+    def clear(self):
+        """ Remove all ports. """
+
+        self.beginResetModel()
+        self._root = PortTreeNode(None, None)
+        self._changes = set()
+        self.endResetModel()
+        self.changeCount.emit(0)
+
+    def labels(self):
+        """ Return the vlan labels, as a list of (vlan, label) tuples. """
+
+        return self._label_list
+
+    def set_labels(self, labels):
+        """ Set the vlan labels to <labels>, a list of (vlan, label) tuples.
+        """
+
+        self._label_list = labels
+        self._labels = dict((str(vlan), label) for vlan, label in labels)
+        self._emit_changed(self._root, NewGui.COL_COMBO, NewGui.COL_COMBO)
+
+    def add_ports(self, ports):
+        """ Add <ports> to the tree, each at the position given by its patch
+            id. """
+
+        for port in ports:
+            node = self._root
+
+            for id_segment in re.split('[_-]', port['patchid']):
+                position = bisect.bisect_left(node.child_names, id_segment)
+
+                if position < len(node.child_names) and \
+                        node.child_names[position] == id_segment:
+                    node = node.children[position]
+                    continue
+
+                parent_index = self._index_of(node)
+
+                self.beginInsertRows(parent_index, position, position)
+                child = PortTreeNode(id_segment, node)
+                node.children.insert(position, child)
+                node.child_names.insert(position, id_segment)
+                self.endInsertRows()
+
+                node = child
+
+            node.port = port
+            node.new_vlan = None
+            self._emit_changed(node, NewGui.COL_SWITCH, NewGui.COL_SUBMIT)
+
+    def port(self, index):
+        """ Return the patchport at <index>, or None if it isn't a leaf. """
+
+        return self._node(index).port
+
+    def new_vlan(self, index):
+        """ Return the vlan selected for the patchport at <index>. """
+
+        node = self._node(index)
+
+        if node.new_vlan is None:
+            return node.port['vlanid']
+
+        return node.new_vlan
+
+    def set_new_vlan(self, index, vlan):
+        """ Select <vlan> for the patchport at <index>. """
+
+        node = self._node(index)
+        node.new_vlan = vlan
+
+        if node.changed():
+            self._changes.add(node)
+        else:
+            self._changes.discard(node)
+
+        self._emit_changed(node, NewGui.COL_COMBO, NewGui.COL_SUBMIT)
+        self.changeCount.emit(len(self._changes))
+
+    def is_changed(self, index):
+        """ Return whether another vlan is selected for the patchport at
+            <index>. """
+
+        return self._node(index).changed()
+
+    def changes(self):
+        """ Return a list of (patchport, new vlan) for all ports with another
+            vlan selected, sorted by patch id. """
+
+        return sorted([(node.port, node.new_vlan) for node in self._changes],
+                      key=lambda change: change[0]['patchid'])
+
+    def apply_changes(self, ports):
+        """ Make the selected vlans of <ports> the actual vlans, after they have
+            been configured. """
+
+        submitted = set(id(port) for port in ports)
+
+        for node in [node for node in self._changes if id(node.port) in submitted]:
+            self._changes.discard(node)
+            node.port['vlanid'] = str(node.new_vlan)
+            node.new_vlan = None
+            self._emit_changed(node, NewGui.COL_VLAN, NewGui.COL_SUBMIT)
+
+        self.changeCount.emit(len(self._changes))
+
+    def _node(self, index):
+        """ Return the node at <index>. """
+
+        if index.isValid():
+            return index.internalPointer()
+
+        return self._root
+
+    def _index_of(self, node, column=0):
+        """ Return the index of <node>. """
+
+        if node is self._root:
+            return QModelIndex()
+
+        return self.createIndex(node.row(), column, node)
+
+    def _emit_changed(self, node, first_column, last_column):
+        """ Emit dataChanged for <node> and all nodes below it. """
+
+        if node is not self._root:
+            self.dataChanged.emit(self._index_of(node, first_column),
+                                  self._index_of(node, last_column))
+
+        for child in node.children:
+            self._emit_changed(child, first_column, last_column)
+
+    def index(self, row, column, parent=QModelIndex()):
+        """ Return the index of the item at <row> and <column> below <parent>.
+        """
+
+        node = self._node(parent)
+
+        if row < 0 or row >= len(node.children):
+            return QModelIndex()
+
+        return self.createIndex(row, column, node.children[row])
+
+    def parent(self, index):
+        """ Return the index of the parent of the item at <index>. """
+
+        if not index.isValid():
+            return QModelIndex()
+
+        return self._index_of(index.internalPointer().parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        """ Return the number of children of <parent>. """
+
+        if parent.column() > 0:
+            return 0
+
+        return len(self._node(parent).children)
+
+    def columnCount(self, parent=QModelIndex()):   # pylint: disable=unused-argument
+        """ Return the number of columns. """
+
+        return len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        """ Return the header of column <section>. """
+
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return QVariant(self.HEADERS[section])
+
+        return QVariant()
+
+    def flags(self, index):
+        """ Return the flags of the item at <index>. Only the vlan of a
+            patchport is editable. """
+
+        if not index.isValid():
+            return Qt.NoItemFlags
+
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
+        if index.column() == NewGui.COL_COMBO and self.port(index) is not None:
+            flags |= Qt.ItemIsEditable
+
+        return flags
+
+    def data(self, index, role=Qt.DisplayRole):
+        """ Return the data of the item at <index>. """
+
+        if not index.isValid() or role != Qt.DisplayRole:
+            return QVariant()
+
+        node = index.internalPointer()
+        column = index.column()
+
+        if column == NewGui.COL_PATCH:
+            return QVariant(node.name)
+
+        port = node.port
+
+        if port is None:
+            return QVariant()
+        elif column == NewGui.COL_SWITCH:
+            return QVariant(port['hostname'])
+        elif column == NewGui.COL_PORT:
+            return QVariant(port['interface'])
+        elif column == NewGui.COL_VLAN:
+            return QVariant(port['vlanid'])
+        elif column == NewGui.COL_COMBO:
+            vlan = str(self.new_vlan(index))
+            return QVariant(self._labels.get(vlan, vlan))
+
+        return QVariant()
+
+
+class VlanDelegate(QStyledItemDelegate):
+    """ Edit the vlan of a patchport with a MyComboBox. The combo box is only
+        created while the port is being edited. """
+
+    def createEditor(self, parent, option, index):  # pylint: disable=unused-argument
+        """ Create a combo box for editing the vlan at <index>. """
+
+        combo_box = MyComboBox(parent)
+        combo_box.fill(index.model().labels())
+        combo_box.currentIndexChanged.connect(
+            lambda current, combo_box=combo_box: self.commitData.emit(combo_box))
+
+        return combo_box
+
+    def setEditorData(self, editor, index):
+        """ Select the vlan at <index> in <editor>. """
+
+        editor.blockSignals(True)
+        editor.selectData(index.model().new_vlan(index))
+        editor.blockSignals(False)
+
+    def setModelData(self, editor, model, index):
+        """ Store the vlan selected in <editor> in <model>. """
+
+        model.set_new_vlan(index, editor.currentData())
+
+
+class SubmitDelegate(QStyledItemDelegate):
+    """ Draw a Submit button for every patchport, without creating a widget
+        for it. Emits the "submitClicked" signal with the index of the port
+        when a button of a changed port is clicked. """
+
+    submitClicked = pyqtSignal(QModelIndex)
+
+    def _button_option(self, option, index):
+        """ Return the style option for the button at <index>. """
+
+        button = QStyleOptionButton()
+        button.rect = option.rect
+        button.text = "Submit"
+        button.state = QStyle.State_Raised
+
+        if index.model().is_changed(index):
+            button.state |= QStyle.State_Enabled
+
+        return button
+
+    def paint(self, painter, option, index):
+        """ Paint the button at <index>. """
+
+        if index.model().port(index) is None:
+            QStyledItemDelegate.paint(self, painter, option, index)
+            return
+
+        QApplication.style().drawControl(QStyle.CE_PushButton,
+                                         self._button_option(option, index),
+                                         painter)
+
+    def sizeHint(self, option, index):
+        """ Return the size of the button at <index>. """
+
+        if index.model().port(index) is None:
+            return QStyledItemDelegate.sizeHint(self, option, index)
+
+        button = self._button_option(option, index)
+        size = button.fontMetrics.size(Qt.TextShowMnemonic, button.text)
+
+        return QApplication.style().sizeFromContents(QStyle.CT_PushButton,
+                                                     button, size)
+
+    def editorEvent(self, event, model, option, index):  # pylint: disable=unused-argument
+        """ Handle a click on the button at <index>. """
+
+        if event.type() == QEvent.MouseButtonRelease and \
+                model.port(index) is not None and model.is_changed(index):
+            self.submitClicked.emit(QModelIndex(index))
+            return True
+
+        return False
+
+
 class NewGui(QApplication):
     """ Port Configurator GUI. """
 
@@ -194,6 +626,9 @@ class NewGui(QApplication):
     COL_COMBO = 4
     COL_SUBMIT = 5
 
+    CONSOLE_TIMEOUT = 30    # Seconds to wait for the output of a console command
+    SHUTDOWN_TIMEOUT = 5    # Seconds to wait for running commands when quitting
+
     OK_COLOR = 'none'
     WARN_COLOR = '#FFA500'
     ERR_COLOR = '#FF0000'
@@ -213,10 +648,12 @@ class NewGui(QApplication):
 
         self._labels = []
 
-        self._changes = []
+        self._port_model = None
+        self._submitted = []    # The ports being configured
 
         self._get_config_thread = None
         self._set_config_thread = None
+        self._console_thread = None
 
         self._win = uic.loadUi("Login.ui")
 
@@ -266,28 +703,64 @@ class NewGui(QApplication):
         self._qsettings.sync()
 
         self._win = uic.loadUi("NewGui.ui")
-        self._win.ports.itemExpanded.connect(lambda item: self._resize())
-        self._win.ports.itemCollapsed.connect(lambda item: self._resize())
+
+        self._port_model = PortTreeModel(self._win.ports)
+        self._port_model.changeCount.connect(
+            lambda count: self._win.buttonSubmitAll.setEnabled(count > 0))
+        self._win.ports.setModel(self._port_model)
+        self._win.ports.setUniformRowHeights(True)
+        self._win.ports.setEditTriggers(QAbstractItemView.AllEditTriggers)
+
+        vlan_delegate = VlanDelegate(self._win.ports)
+        self._win.ports.setItemDelegateForColumn(NewGui.COL_COMBO, vlan_delegate)
+        submit_delegate = SubmitDelegate(self._win.ports)
+        submit_delegate.submitClicked.connect(self._submit_pressed)
+        self._win.ports.setItemDelegateForColumn(NewGui.COL_SUBMIT, submit_delegate)
+
+        self._win.ports.expanded.connect(lambda index: self._resize())
+        self._win.ports.collapsed.connect(lambda index: self._resize())
         self._win.Health.itemExpanded.connect(lambda item: self._resize())
         self._win.Health.itemCollapsed.connect(lambda item: self._resize())
 
         self._win.buttonReload.clicked.connect(self._get_configuration)
         self._win.buttonSubmitAll.clicked.connect(self._submit_all)
         self._win.buttonBugReport.clicked.connect(self._report_bug)
+        self._win.ConsoleCancel.clicked.connect(self._cancel_console)
+        self._win.ConsoleCancel.setEnabled(False)
 
         self._win.statusbar.hide()
         self._win.ports.hideColumn(NewGui.COL_VLAN)
 
         self._win.show()
 
+        self.aboutToQuit.connect(self._shutdown)
+
         self._get_configuration()
 
-    def _handle_new_data(self, data):
-        """ Handle data from the GetConfigurationThread. """
+    def _shutdown(self):
+        """ Stop the console command, and close the connections to the
+            switches. """
+
+        if self._console_thread is not None:
+            self._console_thread.cancel()
+            self._console_thread.wait()
+
+        # Commands still running are abandoned, the workers don't keep the
+        # program alive
+        portconfig.set_switchlist(None, self.SHUTDOWN_TIMEOUT)
+
+    def _hide_message(self):
+        """ Hide the informational message box, if any. """
+
+        if self._msg_box:
+            self._msg_box.hide()
+            self._msg_box.deleteLater()
+            self._msg_box = None
+
+    def _handle_new_vlans(self, vlans):
+        """ Handle the vlans from the GetConfigurationThread. """
 
-        self._ports = data['ports']
-        self._vlans = data['vlans']
-        self._health = data['health']
+        self._vlans = vlans
 
         self._labels = [(None, u'invalid')]
 
@@ -297,27 +770,38 @@ class NewGui(QApplication):
 
             self._labels.append((vlanid, label))
 
-        for i, port in enumerate(self._ports):
+        self._port_model.set_labels(self._labels)
+
+    def _handle_new_ports(self, ports):
+        """ Handle the patchports of a switch from the GetConfigurationThread.
+        """
+
+        self._hide_message()
+
+        for port in ports:
             if port['vlanid'] == 'unassigned':
-                self._ports[i]['vlanid'] = 'dynamic'
+                port['vlanid'] = 'dynamic'
 
-        # print "Ports:"
-        # pprint.pprint(self._ports)
+        self._ports.extend(ports)
+        self._port_model.add_ports(ports)
 
-        # print "VLANs:"
-        # pprint.pprint(self._vlans)
+        self._resize()
+
+    def _handle_new_health(self, health):
+        """ Handle the health of a switch from the GetConfigurationThread. """
 
-        self._refresh()
+        for entry in health:
+            entry['item'] = self._add_to_health(entry)
+            self._health.append(entry)
+
+        self._resize()
 
     def _get_config_thread_finished(self):
         """ Handle completion of the GetConfigurationThread. """
 
         self._get_config_thread.deleteLater()
 
-        if self._msg_box:
-            self._msg_box.hide()
-            self._msg_box.deleteLater()
-            self._msg_box = None
+        self._hide_message()
 
         scroll_area = self._win.scrollAreaWidgetContents
         scroll_area.setMinimumHeight(150 * len(portconfig.switchlist.seen))
@@ -342,24 +826,46 @@ class NewGui(QApplication):
         self._win.ConsoleInput.returnPressed.connect(self._sendToAll)
 
     def _sendToAll(self):
-        ExecuteOn = []
+        """ Execute the command in the console input on all checked switches,
+            in the background. """
+
+        if self._console_thread is not None:
+            return  # Still busy with the previous command
+
         command = str(self._win.ConsoleInput.text())
-        cpu_count = 25  # multiprocessing.cpu_count()
-        print >>sys.stderr, "Process count %d" % cpu_count
-        for host, cb in enumerate(self.checkboxes):
-            if self.checkboxes[cb].isChecked():
-                print "Execute on " + cb
-                ExecuteOn.append(cb)
-        pool = multiprocessing.Pool(processes=cpu_count)
-        results = []
-        for host in ExecuteOn:
-            results.append(pool.apply_async(
-                execute_custom, (host, 23, self._user, self._pass, command)))
-        pool.close()
-        pool.join()
-        results = [r.get() for r in results]
-        for host in results:
-            self.textboxes[host.keys()[0]].setText(host[host.keys()[0]])
+        hosts = [host for host in self.checkboxes
+                 if self.checkboxes[host].isChecked()]
+
+        for host in hosts:
+            self.textboxes[host].setText("Executing %s..." % command)
+
+        self._console_thread = ConsoleThread(portconfig.switchlist, hosts,
+                                             command, self.CONSOLE_TIMEOUT)
+        self._console_thread.hostResult.connect(self._console_result)
+        self._console_thread.finished.connect(self._console_thread_finished)
+        self._win.ConsoleInput.setEnabled(False)
+        self._win.ConsoleCancel.setEnabled(True)
+        self._console_thread.start()
+
+    def _console_result(self, host, output):
+        """ Show the <output> of the console command on <host>. """
+
+        self.textboxes[str(host)].setText(output)
+
+    def _cancel_console(self):
+        """ The user has pressed the console Cancel button. Handle this. """
+
+        if self._console_thread is not None:
+            self._console_thread.cancel()
+
+    def _console_thread_finished(self):
+        """ Handle completion of the ConsoleThread. """
+
+        self._console_thread.deleteLater()
+        self._console_thread = None
+
+        self._win.ConsoleInput.setEnabled(True)
+        self._win.ConsoleCancel.setEnabled(False)
 
     def _show_message(self, text):
         """ Show an informational message box with <text>. """
@@ -377,14 +883,20 @@ class NewGui(QApplication):
     def _get_configuration(self):
         """ Get the current network configuration. """
 
-        self._win.ports.clear()
+        self._port_model.clear()
+        self._win.Health.clear()
+
+        self._ports = []
+        self._health = []
 
         self._show_message('Getting switch configuration; please wait.')
 
         self._get_config_thread = GetConfigurationThread(self._host,
                                                          self._user,
                                                          self._pass)
-        self._get_config_thread.newData.connect(self._handle_new_data)
+        self._get_config_thread.newVlans.connect(self._handle_new_vlans)
+        self._get_config_thread.newPorts.connect(self._handle_new_ports)
+        self._get_config_thread.newHealth.connect(self._handle_new_health)
         self._get_config_thread.finished.connect(self._get_config_thread_finished)
         self._get_config_thread.start()
 
@@ -392,45 +904,17 @@ class NewGui(QApplication):
         """ Resize the columns of the data table based on its current contents.
         """
 
-        for col in range(self._win.ports.columnCount()):
+        for col in range(self._port_model.columnCount()):
             self._win.ports.resizeColumnToContents(col)
         for col in range(self._win.Health.columnCount()):
             self._win.Health.resizeColumnToContents(col)
 
-    def _refresh(self):
-        """ Refresh the data table based on the current data. """
-
-        self._win.ports.clear()
-        self._win.Health.clear()
-
-        for index, port in enumerate(self._ports):
-            self._ports[index]['item'] = self._add_to_tree(port)
-
-        for index, health in enumerate(self._health):
-            self._health[index]['item'] = self._add_to_health(health)
-
-        self._resize()
-
-    def _reset_children(self, item):
-        """ Reset the current vlan number and disable the Submit button for all
-            the child items below <item>. """
-
-        for index in range(item.childCount()):
-            child = item.child(index)
-
-            if child.childCount() == 0:
-                new_vlan_id = str(self._win.ports.itemWidget(child,
-                                                             NewGui.COL_COMBO).currentData())
-                child.setText(NewGui.COL_VLAN, new_vlan_id)
-
-                button = self._win.ports.itemWidget(child, NewGui.COL_SUBMIT)
-                button.setEnabled(False)
-            else:
-                self._reset_children(child)
-
     def _set_config_thread_finished(self):
         """ Handle completion of the SetConfigurationThread. """
 
+        # Ports on switches that failed keep their selected vlan, to submit again
+        configured = [port for port in self._submitted
+                      if self._set_config_thread.succeeded(port['hostname'])]
         self._set_config_thread.deleteLater()
 
         if self._msg_box:
@@ -438,47 +922,23 @@ class NewGui(QApplication):
             self._msg_box.deleteLater()
             self._msg_box = None
 
-        self._reset_children(self._win.ports.invisibleRootItem())
-
-        self._changes = []
+        self._port_model.apply_changes(configured)
+        self._submitted = []
 
-        self._win.buttonSubmitAll.setEnabled(False)
+    def _submit_pressed(self, index):
+        """ The user has pressed the Submit button for the port at model index
+            <index>. Handle this."""
 
-    def _vlan_selected(self, index, item):
-        """ The user selected the vlan number with index <index> in the combo
-            box for QTreeWidgetItem <item>. """
-
-        vlan_combo = self._win.ports.itemWidget(item, NewGui.COL_COMBO)
-        submit_button = self._win.ports.itemWidget(item, NewGui.COL_SUBMIT)
-
-        cur_vlan = str(item.text(NewGui.COL_VLAN))
-        new_vlan = str(vlan_combo.itemData(index))
-
-        submit_button.setEnabled(new_vlan != cur_vlan)
-
-        if new_vlan == cur_vlan and item in self._changes:
-            self._changes.remove(item)
-        elif new_vlan != cur_vlan and item not in self._changes:
-            self._changes.append(item)
-
-        self._win.buttonSubmitAll.setEnabled(len(self._changes) > 0)
-
-    def _submit_pressed(self, port, item):
-        """ The user has pressed the Submit button for <port> in QTreeWidgetItem
-            <item>. Handle this."""
-
-        switch_host = port['hostname']
-        switch_port = port['interface']
-        old_vlan_id = str(item.text(NewGui.COL_VLAN))
-        new_vlan_id = str(self._win.ports.itemWidget(item,
-                                                     NewGui.COL_COMBO).currentData())
+        port = self._port_model.port(index)
+        new_vlan_id = str(self._port_model.new_vlan(index))
 
         self._show_message('Setting port %s to vlan %s; please wait.' %
                            (port['patchid'], new_vlan_id))
 
         self._set_config_thread = SetConfigurationThread(self._user, self._pass)
-        self._set_config_thread.addJob(switch_host, switch_port,
-                                       old_vlan_id, new_vlan_id)
+        self._set_config_thread.addJob(port['hostname'], port['interface'],
+                                       str(port['vlanid']), new_vlan_id)
+        self._submitted = [port]
         self._set_config_thread.finished.connect(
             self._set_config_thread_finished)
         self._set_config_thread.start()
@@ -491,25 +951,20 @@ class NewGui(QApplication):
 
         text = ""
 
-        for port in self._ports:
-            item = port['item']
+        self._submitted = []
 
-            current_data = self._win.ports.itemWidget(item,
-                                                      NewGui.COL_COMBO).currentData()
+        for port, new_vlan in self._port_model.changes():
+            self._submitted.append(port)
 
-            if current_data is None:
-                continue
-
-            old_vlan_id = str(item.text(NewGui.COL_VLAN))
-            new_vlan_id = str(current_data)
+            old_vlan_id = str(port['vlanid'])
+            new_vlan_id = str(new_vlan)
 
-            if new_vlan_id != old_vlan_id:
-                self._set_config_thread.addJob(port['hostname'],
-                                               port['interface'],
-                                               old_vlan_id, new_vlan_id)
+            self._set_config_thread.addJob(port['hostname'],
+                                           port['interface'],
+                                           old_vlan_id, new_vlan_id)
 
-                text += '- Change port %s from vlan %s to vlan %s.\n' \
-                        % (port['patchid'], old_vlan_id, new_vlan_id)
+            text += '- Change port %s from vlan %s to vlan %s.\n' \
+                    % (port['patchid'], old_vlan_id, new_vlan_id)
 
         if self._set_config_thread.jobCount() > 0 and \
                 QMessageBox.question(self._win, "OK to submit?",
@@ -572,60 +1027,6 @@ class NewGui(QApplication):
         item.addChild(child)
         return item
 
-    def _add_to_tree(self, port):
-        """ Add an entry for port <port> to the QTreeWidget. """
-
-        # Start at the root of the tree.
-        item = self._win.ports.invisibleRootItem()
-
-        # Split the patch id into segments, and for every segment...
-        for id_segment in re.split('[_-]', port['patchid']):
-            id_segment_to_index = {}
-
-            # Get the names of all the child items at the current tree level...
-            for i in range(item.childCount()):
-                segment_name = str(item.child(i).text(NewGui.COL_PATCH))
-
-                id_segment_to_index[segment_name] = i
-
-            # If there already is a child item for this segment...
-            if id_segment in id_segment_to_index:
-                # then select that child to follow,
-                child_index = id_segment_to_index[id_segment]
-                child = item.child(child_index)
-            else:
-                # otherwise create and select a new child.
-                child = QTreeWidgetItem(item, [id_segment])
-                item.addChild(child)
-
-            # Make the selected child the current item and do it all again.
-            item = child
-
-        item.setText(NewGui.COL_SWITCH, port['hostname'])
-        item.setText(NewGui.COL_PORT, port['interface'])
-        item.setText(NewGui.COL_VLAN, port['vlanid'])
-
-        combo_box = MyComboBox(self._win.ports)
-
-        combo_box.fill(self._labels)
-        combo_box.selectData(port['vlanid'])
-
-        self._win.ports.setItemWidget(item, NewGui.COL_COMBO, combo_box)
-
-        combo_box.currentIndexChanged.connect(
-            lambda index, item=item: self._vlan_selected(index, item))
-
-        submit = QPushButton("Submit", self._win.ports)
-        submit.clicked.connect(
-            lambda checked, port=port, item=item:
-            self._submit_pressed(port, item))
-
-        submit.setEnabled(False)
-
-        self._win.ports.setItemWidget(item, NewGui.COL_SUBMIT, submit)
-
-        return item
-
 
 if __name__ == '__main__':
     app = NewGui(sys.argv)
@@ -17,31 +17,77 @@
 # along with nettools.  If not, see <http://www.gnu.org/licenses/>.
 """ This module provides the OutLog class. """
 
+import threading
+
 import PyQt4.QtGui as QtGui
+import PyQt4.QtCore as QtCore
+
+
+class OutLogBuffer(QtCore.QObject):
+    """ Collects the text written to a QTextEdit by one or more OutLogs, from any thread, and appends it to
+        the QTextEdit in batches from a timer in the GUI thread. """
+
+    def __init__(self, edit, interval=100, max_lines=5000):
+        """ Flush every interval milliseconds, keep at most max_lines lines in edit """
+        QtCore.QObject.__init__(self, edit)
+        self.edit = edit
+        self.lock = threading.Lock()
+        self.runs = []  # [(color, [text, ...])], runs of text in a single color
+        self.edit.document().setMaximumBlockCount(max_lines)
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.flush)
+        self.timer.start(interval)
+
+    def append(self, msg, color):
+        """ Queue msg to be shown in color. Safe to call from any thread. """
+        with self.lock:
+            if self.runs and self.runs[-1][0] == color:
+                self.runs[-1][1].append(msg)
+            else:
+                self.runs.append((color, [msg]))
+
+    def flush(self):
+        """ Append the queued text to the QTextEdit. Must be called from the GUI thread. """
+        with self.lock:
+            runs = self.runs
+            self.runs = []
+        if not runs:
+            return
+
+        scrollbar = self.edit.verticalScrollBar()
+        at_bottom = scrollbar.value() == scrollbar.maximum()
+
+        cursor = QtGui.QTextCursor(self.edit.document())
+        cursor.movePosition(QtGui.QTextCursor.End)
+        cursor.beginEditBlock()
+        for color, texts in runs:
+            text_format = QtGui.QTextCharFormat()
+            text_format.setForeground(QtGui.QBrush(color if color else self.edit.textColor()))
+            cursor.insertText("".join(texts), text_format)
+        cursor.endEditBlock()
+
+        if at_bottom:
+            scrollbar.setValue(scrollbar.maximum())
 
 
 class OutLog(object):
     """ Outlog enables one to redirect stdout and stderr to a QTextEdit widget. """
 
+    buffers = {}  # QTextEdit -> OutLogBuffer, shared so stdout and stderr stay in order
+
     def __init__(self, edit, out=None, color=None):
-        """ (edit, out=None, color=None) -> can write stdout, stderr to a QTextEdit. """
+        """ (edit, out=None, color=None) -> can write stdout, stderr to a QTextEdit. Must be created in the
+            GUI thread, but can be written to from any thread. """
         self.edit = edit
         self.out = out
         self.color = color
+        if edit not in self.buffers:
+            self.buffers[edit] = OutLogBuffer(edit)
+        self.buffer = self.buffers[edit]
 
     def write(self, msg):
-        """ Write a message to output and QTextEdit. """
-        if self.color:
-            txt_color = self.edit.textColor()
-            self.edit.setTextColor(self.color)
-
-        self.edit.moveCursor(QtGui.QTextCursor.End)
-        self.edit.insertPlainText(msg)
-
-        self.edit.ensureCursorVisible()
-
-        if self.color:
-            self.edit.setTextColor(txt_color)
+        """ Write a message to output, and queue it for the QTextEdit. """
+        self.buffer.append(msg, self.color)
 
         if self.out:
             try:
@@ -50,7 +96,7 @@ class OutLog(object):
                 pass
 
     def flush(self):
-        """ Flush output. """
+        """ Flush output. The QTextEdit is flushed by its timer. """
         if self.out:
             try:
                 self.out.flush()
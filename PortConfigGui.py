@@ -221,21 +221,28 @@ class PortConfigGui(QtGui.QMainWindow):
 
     def _submit_pressed(self, row_number):
         """ Qt slot for when a submit button was pressed """
-        patchData = self._get_combobox_variantdata(row_number, 0)
-        vlanData = self._get_combobox_variantdata(row_number, 2)
-
-        username = self.username
-        password = self.password
-        switch_hostname = patchData['hostname']
-        switchport = patchData['interface']
-        old_vlanid = patchData['vlanid']
-        vlanid = vlanData['vlanid']
+        job = self._row_job(row_number)
 
         QApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
-        portconfig.configure_patchid_raw(
-            username, password, switch_hostname, switchport, vlanid, old_vlanid)
+        results = portconfig.configure_patchids_raw(self.username, self.password, [job])
         QApplication.restoreOverrideCursor()
 
+        if results[job['switch_host']]:
+            self._row_submitted(row_number, job['new_vlan_id'])
+
+    def _row_job(self, row_number):
+        """ Get the configuration job for a row, as used by portconfig.configure_patchids_raw """
+        patchData = self._get_combobox_variantdata(row_number, 0)
+        vlanData = self._get_combobox_variantdata(row_number, 2)
+
+        return {'switch_host': patchData['hostname'],
+                'switch_port': patchData['interface'],
+                'old_vlan_id': patchData['vlanid'],
+                'new_vlan_id': vlanData['vlanid']}
+
+    def _row_submitted(self, row_number, vlanid):
+        """ Remember that the patchport of a row is now configured to vlanid """
+        patchData = self._get_combobox_variantdata(row_number, 0)
         patchData['vlanid'] = vlanid
         self._set_combobox_variantdata(row_number, 0, QVariant(str(patchData)))
 
@@ -248,9 +255,16 @@ class PortConfigGui(QtGui.QMainWindow):
     def _submit_all(self):
         """ Qt slot for submitting all lines """
         print "Submit all..."
-        rows = self.tableWidget.rowCount() - 1
-        for row in range(0, rows):
-            self._submit_pressed(row)
+        rows = range(0, self.tableWidget.rowCount() - 1)
+        jobs = [self._row_job(row) for row in rows]
+
+        QApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
+        results = portconfig.configure_patchids_raw(self.username, self.password, jobs)
+        QApplication.restoreOverrideCursor()
+
+        for row, job in zip(rows, jobs):
+            if results[job['switch_host']]:  # Rows of switches that failed keep their old VLAN, to submit again
+                self._row_submitted(row, job['new_vlan_id'])
 
 
 if __name__ == '__main__':
@@ -261,6 +275,7 @@ if __name__ == '__main__':
     main_hostname = sys.argv[3]
 
     app = QApplication(sys.argv)
+    app.aboutToQuit.connect(lambda: portconfig.set_switchlist(None))
     pcg = PortConfigGui(main_hostname, sys.argv[1], sys.argv[2])
     pcg.show()
     pcg.redirect_stdout()
@@ -0,0 +1,33 @@
+#/usr/bin/env python
+#
+# Copyright (C) 2016-2017 DNW German-Dutch Wind Tunnels
+#
+# This file is part of nettools.
+# Nettools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with nettools.  If not, see <http://www.gnu.org/licenses/>.
+""" This module defines write_atomic, which replaces a file without readers ever seeing half of it """
+
+import threading
+import os
+
+
+def write_atomic(filename, contents):
+    """ Write contents to filename through a temporary file next to it, which is renamed over filename when
+        complete. The temporary file is unique per process and thread, so concurrent writers don't mix up their
+        contents. """
+    temp_filename = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.current_thread().ident)
+    with open(temp_filename, "w") as fd:
+        fd.write(contents)
+    if os.name == "nt" and os.path.exists(filename):
+        os.remove(filename)  # rename doesn't replace files on Windows
+    os.rename(temp_filename, filename)
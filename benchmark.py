@@ -0,0 +1,222 @@
+#/usr/bin/env python
+#
+# Copyright (C) 2016-2017 DNW German-Dutch Wind Tunnels
+#
+# This file is part of nettools.
+# Nettools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with nettools.  If not, see <http://www.gnu.org/licenses/>.
+""" Benchmarks for nettools, run against a local fake IOS server """
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+
+from Cisco import CiscoTelnetSession, CiscoSet
+from fake_ios import start_fake_ios, start_fake_network, stop_fake_network, synthetic_network
+from fake_ios import ReplayTelnet, record_transcripts, save_transcripts, load_transcripts
+from fake_ios import mac_address_table_output, interface_status_output, cdp_neighbors_output
+from network_overview import get_network_overview, write_snapshot
+
+# The session derives its prompt from the part of the hostname before the first dot
+benchmark_host = "127.0.0.1"
+benchmark_prompt = benchmark_host[:benchmark_host.find(".")]
+
+
+def timed(function, *args):
+    """ Call function and return the number of seconds it took """
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def vlan_batch(session, port_count):
+    """ Produce a config session setting port_count ports to a VLAN """
+    command = "config t" + session.newline
+    for i in range(1, port_count + 1):
+        command += session.set_single_interface_vlan("Gi1/0/%d" % i, "10")
+    command += "end"
+    return command
+
+
+def benchmark_pacing(port_count):
+    """ Compare line pacing with character pacing for a VLAN batch """
+    server = start_fake_ios(benchmark_prompt)
+    port = server.server_address[1]
+
+    session = CiscoTelnetSession()
+    session.open(benchmark_host, port, server.username, server.password)
+    command = vlan_batch(session, port_count)
+    try:
+        CiscoTelnetSession.character_paced_hosts.discard(benchmark_host)
+        line_seconds = timed(session.execute_command, command)
+        print "line pacing:      %3d ports in %8.3f s" % (port_count, line_seconds)
+
+        CiscoTelnetSession.character_paced_hosts.add(benchmark_host)
+        character_seconds = timed(session.execute_command, command)
+        print "character pacing: %3d ports in %8.3f s" % (port_count, character_seconds)
+    finally:
+        session.session.close()  # Lets the connection thread of the server finish before the interpreter exits
+        server.shutdown()
+        server.server_close()
+
+
+def repeated(count, function, *args):
+    """ Call function(*args) count times """
+    for _ in range(count):
+        function(*args)
+
+
+def legacy_filter(session, regex_parts, output):
+    """ Parse output the way the show methods did before the parser registry existed """
+    regex = ""
+    for part in regex_parts:
+        regex += part
+    return session.filter_output(output, regex)
+
+
+def benchmark_parsers(entry_count, repeat=10):
+    """ Compare per-call regex building with the precompiled parser registry """
+    session = CiscoTelnetSession()
+    session.host = "switch01"
+    macs = ["%04x.%04x.%04x" % (i >> 16, i & 0xffff, i) for i in range(entry_count)]
+    interfaces = ["Gi%d/0/%d" % (i / 48 % 9 + 1, i % 48 + 1) for i in range(entry_count)]
+    outputs = {
+        "show_mac_address_table": mac_address_table_output(
+            [(str(i % 100 + 1), macs[i], interfaces[i]) for i in range(entry_count)]),
+        "show_interface_vlan": interface_status_output(
+            [(interfaces[i], "a1-%02d-%02d" % (i / 48, i % 48), "connected", str(i % 100 + 1))
+             for i in range(entry_count)]),
+        "show_neighbors": cdp_neighbors_output(
+            [("switch%03d.example.com" % i, interfaces[i].replace("Gi", "Gig "), "Gig 1/0/49")
+             for i in range(entry_count)])}
+    regex = CiscoTelnetSession
+    legacy_regexes = {
+        "show_mac_address_table": [regex.regex_whitespace, regex.regex_vlanid, regex.regex_whitespace,
+                                   regex.regex_macaddress, regex.regex_whitespace, regex.regex_macaddress_type,
+                                   regex.regex_whitespace, regex.regex_port],
+        "show_interface_vlan": [regex.regex_interface, regex.regex_whitespace, regex.regex_patchid,
+                                regex.regex_whitespace, regex.regex_string, regex.regex_whitespace,
+                                regex.regex_vlanid],
+        "show_neighbors": [regex.regex_deviceid, regex.regex_whitespace, regex.regex_interface,
+                           regex.regex_whitespace, regex.regex_holdtime, regex.regex_whitespace,
+                           regex.regex_capabilities, regex.regex_whitespace, regex.regex_platform,
+                           regex.regex_optionalwhitespace, regex.regex_portid]}
+
+    for name in sorted(outputs):
+        output = outputs[name]
+        parser = CiscoTelnetSession.parsers[name]
+        assert len(parser.dicts(output, session.host)) == entry_count
+        legacy_seconds = timed(repeated, repeat, legacy_filter, session, legacy_regexes[name], output)
+        dicts_seconds = timed(repeated, repeat, parser.dicts, output, session.host)
+        print "%-24s legacy %8.3f s, dicts %8.3f s (%d x %d lines)" % (
+            name, legacy_seconds, dicts_seconds, repeat, entry_count)
+
+
+def benchmark_network(start_host, port, username="admin", password="admin"):
+    """ Time discover_devices, execute_on_all and the network_overview pipeline, starting without a topology
+        cache. The second overview is answered from the cache, like the next run of network_overview. """
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)  # The topology cache is kept in the working directory
+    switchset = CiscoSet(username, password, start_host, port)
+    try:
+        seconds = timed(switchset.discover_devices)
+        print "discover_devices:  %4d devices in %8.3f s" % (len(switchset.seen), seconds)
+
+        results = []
+        seconds = timed(lambda: results.extend(switchset.execute_on_all(CiscoTelnetSession.show_interface_vlan)))
+        print "execute_on_all:    %4d devices in %8.3f s, %d ports" % (len(switchset.seen), seconds, len(results))
+
+        overview = {}
+        seconds = timed(lambda: overview.update(get_network_overview(switchset, start_host, start_host)))
+        print "network overview:  %4d devices in %8.3f s, %d mac entries" % (
+            len(switchset.seen), seconds, len(overview["mac"]))
+        seconds = timed(write_snapshot, overview, os.path.join(workdir, "snapshot"))
+        print "snapshot:          %4d devices in %8.3f s, %d IPs" % (len(switchset.seen), seconds, len(overview["arp"]))
+        seconds = timed(get_network_overview, switchset, start_host, start_host)
+        print "cached overview:   %4d devices in %8.3f s" % (len(switchset.seen), seconds)
+
+        totals = {}  # phase -> (calls, seconds), summed over all workers
+        for row in switchset.statistics.rows():
+            calls, seconds = totals.get(row["phase"], (0, 0.0))
+            totals[row["phase"]] = (calls + row["calls"], seconds + row["seconds"])
+        for phase in sorted(totals):
+            print "%-18s %6d calls, %8.3f s on all workers" % (phase + ":", totals[phase][0], totals[phase][1])
+    finally:
+        switchset.close()
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+def benchmark_replay(transcripts, start_host):
+    """ Run benchmark_network on recorded transcripts, without any network traffic """
+    transport = CiscoTelnetSession.transport
+    ReplayTelnet.transcripts = transcripts
+    CiscoTelnetSession.transport = ReplayTelnet
+    try:
+        benchmark_network(start_host, 23, ReplayTelnet.username, ReplayTelnet.password)
+    finally:
+        CiscoTelnetSession.transport = transport
+
+
+def benchmark_telnet(switch_count, latency=0.0, echo_delay=0.0):
+    """ Run benchmark_network on a synthetic network of fake IOS servers on local addresses """
+    hosts = ["127.0.%d.%d" % (index / 250 + 1, index % 250 + 1) for index in range(switch_count)]
+    servers = start_fake_network(synthetic_network(hosts), latency=latency, echo_delay=echo_delay)
+    try:
+        benchmark_network(hosts[0], servers[0].server_address[1], servers[0].username, servers[0].password)
+    finally:
+        stop_fake_network(servers)
+
+
+def record(start_host, username, password, filename):
+    """ Discover the network from start_host and save transcripts of all its devices for benchmark_replay """
+    switchset = CiscoSet(username, password, start_host, 23)
+    try:
+        switchset.discover_devices()
+        save_transcripts(record_transcripts(switchset), filename)
+    finally:
+        switchset.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: " + sys.argv[0] + " pacing [port-count]\n")
+        sys.stderr.write("Usage: " + sys.argv[0] + " parsers [entry-count]\n")
+        sys.stderr.write("Usage: " + sys.argv[0] + " replay [switch-count | transcript-file first-switch]\n")
+        sys.stderr.write("Usage: " + sys.argv[0] + " telnet [switch-count [latency [echo-delay]]]\n")
+        sys.stderr.write("Usage: " + sys.argv[0] + " record first-switch username password transcript-file\n")
+        sys.exit(-1)
+
+    if sys.argv[1] == "pacing":
+        benchmark_pacing(int(sys.argv[2]) if len(sys.argv) > 2 else 3)
+    elif sys.argv[1] == "parsers":
+        benchmark_parsers(int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+    elif sys.argv[1] == "replay" and len(sys.argv) > 3:
+        benchmark_replay(load_transcripts(sys.argv[2]), sys.argv[3])
+    elif sys.argv[1] == "replay":
+        main_hosts = ["switch%03d.example.com" % number for number in range(int(sys.argv[2]) if len(sys.argv) > 2 else 500)]
+        benchmark_replay(synthetic_network(main_hosts), main_hosts[0])
+    elif sys.argv[1] == "telnet":
+        benchmark_telnet(int(sys.argv[2]) if len(sys.argv) > 2 else 500,
+                         float(sys.argv[3]) if len(sys.argv) > 3 else 0.0,
+                         float(sys.argv[4]) if len(sys.argv) > 4 else 0.0)
+    elif sys.argv[1] == "record" and len(sys.argv) > 5:
+        record(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5])
+    else:
+        sys.stderr.write("Unknown benchmark: " + sys.argv[1] + "\n")
+        sys.exit(-1)
+
+    sys.exit(0)
@@ -0,0 +1,104 @@
+#/usr/bin/env python
+#
+# Copyright (C) 2016-2017 DNW German-Dutch Wind Tunnels
+#
+# This file is part of nettools.
+# Nettools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with nettools.  If not, see <http://www.gnu.org/licenses/>.
+""" This module defines the CommandStatistics class, which collects the timing of the commands run on devices """
+
+import json
+import threading
+import time
+
+from atomic_file import write_atomic
+
+
+class CommandStatistics(object):
+    """ Durations, byte counts, retries and timeouts of the commands executed on devices, per host, command and
+        phase. The phases are login, write (sending the command and waiting for its echo), read (waiting for the
+        prompt), execute (write and read including reconnects) and parse. """
+
+    # Totals per host, command and phase, with their Prometheus type and help text
+    counters = [
+        ("calls", "counter", "Number of times the phase ran"),
+        ("seconds", "counter", "Seconds spent in the phase"),
+        ("max_seconds", "gauge", "Longest single run of the phase in seconds"),
+        ("bytes_sent", "counter", "Bytes written to the device"),
+        ("bytes_received", "counter", "Bytes read from the device"),
+        ("retries", "counter", "Reconnects after the device hung up"),
+        ("timeouts", "counter", "Times the device didn't answer in time")]
+    prometheus_prefix = "nettools_command_"
+
+    def __init__(self):
+        self.started = time.time()
+        self.entries = {}  # (hostname, command, phase) -> counter name -> total
+        self.lock = threading.Lock()
+
+    def record(self, hostname, command, phase, seconds, **counters):
+        """ Add a run of phase of command on hostname, which took seconds, to the totals. Other counters
+            (bytes_sent, bytes_received, retries, timeouts) are passed as keyword arguments. """
+        key = (hostname, command, phase)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = dict((name, 0) for name, _, _ in self.counters)
+                self.entries[key] = entry
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            for name, value in counters.items():
+                entry[name] += value
+
+    def rows(self):
+        """ Get a copy of the totals as a sorted list of dicts, with hostname, command and phase """
+        with self.lock:
+            entries = sorted(self.entries.items())
+        rows = []
+        for (hostname, command, phase), entry in entries:
+            row = dict(entry)
+            row.update({"hostname": hostname, "command": command, "phase": phase})
+            rows.append(row)
+        return rows
+
+    def to_json(self):
+        """ Format the totals as json """
+        return json.dumps({"started": self.started, "saved": time.time(), "commands": self.rows()}, indent=1)
+
+    @staticmethod
+    def prometheus_label(value):
+        """ Escape a label value for the Prometheus text format """
+        return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    def to_prometheus(self):
+        """ Format the totals in the Prometheus text exposition format, e.g. for the textfile collector of the
+            node exporter """
+        rows = self.rows()
+        lines = []
+        for name, metric_type, description in self.counters:
+            metric = self.prometheus_prefix + name + ("_total" if metric_type == "counter" else "")
+            lines.append("# HELP %s %s" % (metric, description))
+            lines.append("# TYPE %s %s" % (metric, metric_type))
+            for row in rows:
+                labels = ",".join('%s="%s"' % (label, self.prometheus_label(str(row[label])))
+                                  for label in ("hostname", "command", "phase"))
+                lines.append("%s{%s} %s" % (metric, labels, repr(float(row[name]))))
+        return "\n".join(lines) + "\n"
+
+    def save(self, filename):
+        """ Save the totals to filename, in the Prometheus text format if it ends in .prom and as json otherwise """
+        if filename.endswith(".prom"):
+            contents = self.to_prometheus()
+        else:
+            contents = self.to_json()
+        write_atomic(filename, contents)
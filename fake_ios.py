@@ -0,0 +1,517 @@
+#/usr/bin/env python
+#
+# Copyright (C) 2016-2017 DNW German-Dutch Wind Tunnels
+#
+# This file is part of nettools.
+# Nettools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with nettools.  If not, see <http://www.gnu.org/licenses/>.
+""" A minimal fake Cisco IOS telnet server, for benchmarking without real switches """
+
+import SocketServer
+import threading
+import socket
+import errno
+import json
+import time
+import sys
+import re
+
+from Cisco import CiscoTelnetSession
+
+
+def mac_address_table_output(entries):
+    """ Produce show mac address-table output for a list of (vlanid, macaddress, port) """
+    lines = ["          Mac Address Table",
+             "-------------------------------------------",
+             "",
+             "Vlan    Mac Address       Type        Ports",
+             "----    -----------       --------    -----",
+             " All    0100.0ccc.cccc    STATIC      CPU"]
+    lines += [" %4s    %s    DYNAMIC     %s" % entry for entry in entries]
+    lines.append("Total Mac Addresses for this criterion: %d" % (len(entries) + 1))
+    return "\n".join(lines) + "\n"
+
+
+def interface_status_output(ports):
+    """ Produce show interface status output for a list of (interface, description, status, vlanid) """
+    lines = ["", "Port      Name               Status       Vlan       Duplex  Speed Type"]
+    lines += ["%-9s %-18s %-12s %-10s a-full a-1000 10/100/1000BaseTX" % port for port in ports]
+    return "\n".join(lines) + "\n"
+
+
+def cdp_neighbors_output(neighbors):
+    """ Produce show cdp neighbors output for a list of (deviceid, local interface, remote interface) """
+    lines = ["Capability Codes: R - Router, T - Trans Bridge, B - Source Route Bridge",
+             "                  S - Switch, H - Host, I - IGMP, r - Repeater, P - Phone",
+             "",
+             "Device ID        Local Intrfce     Holdtme    Capability  Platform  Port ID"]
+    lines += ["%-16s %-17s 150            S I   WS-C3750X %s" % neighbor for neighbor in neighbors]
+    return "\n".join(lines) + "\n"
+
+
+def vlan_brief_output(vlans):
+    """ Produce show vlan brief output for a list of (vlanid, vlanname) """
+    lines = ["", "VLAN Name                             Status    Ports",
+             "---- -------------------------------- --------- -------------------------------"]
+    lines += ["%-4s %-32s active    " % vlan for vlan in vlans]
+    return "\n".join(lines) + "\n"
+
+
+def arp_output(entries):
+    """ Produce show arp output for a list of (ip, macaddress, vlanid) """
+    lines = ["Protocol  Address          Age (min)  Hardware Addr   Type   Interface"]
+    lines += ["Internet  %-16s %4d   %s  ARPA   Vlan%s" % (ip, index % 240, macaddress, vlanid)
+              for index, (ip, macaddress, vlanid) in enumerate(entries)]
+    return "\n".join(lines) + "\n"
+
+
+def interface_vlan_setting_output(settings):
+    """ Produce the output of show run | inc (interface)|switchport access vlan for a list of (interface, vlanid),
+        where vlanid is None for interfaces without an access VLAN """
+    lines = []
+    for interface, vlanid in settings:
+        lines.append("interface " + interface.replace("Gi", "GigabitEthernet", 1))
+        if vlanid is not None:
+            lines.append(" switchport access vlan %s" % vlanid)
+    return "\n".join(lines) + "\n"
+
+
+def synthetic_neighbors(hosts, index, fanout):
+    """ Produce the CDP neighbors of the index'th switch of a synthetic_network, its parent and children """
+    neighbors = []
+    if index > 0:
+        parent = (index - 1) / fanout
+        neighbors.append((hosts[parent], "Gig 1/0/49", "Gig 1/1/%d" % ((index - 1) % fanout + 1)))
+    for child in range(index * fanout + 1, min(index * fanout + fanout + 1, len(hosts))):
+        neighbors.append((hosts[child], "Gig 1/1/%d" % ((child - 1) % fanout + 1), "Gig 1/0/49"))
+    return neighbors
+
+
+def synthetic_switch_outputs(hosts, index, ports_per_switch, fanout, vlans):
+    """ Produce the outputs of the index'th switch of a synthetic_network, and the ARP entries of its devices """
+    ports = []
+    settings = []
+    mac_entries = []
+    arp = []
+    for port in range(1, ports_per_switch + 1):
+        interface = "Gi1/0/%d" % port
+        vlanid = vlans[port % 4 + 1][0]
+        macaddress = "0050.%04x.%04x" % (index, port)
+        ports.append((interface, "s%03d-%02d-%02d" % (index, port / 24 + 1, port % 24 + 1), "connected", vlanid))
+        settings.append((interface, vlanid))
+        mac_entries.append((vlanid, macaddress, interface))
+        arp.append(("10.%d.%d.%d" % (index / 250, index % 250, port), macaddress, vlanid))
+    ports.append(("Gi1/0/49", "uplink-00-01", "connected", "trunk"))
+    settings.append(("Gi1/0/49", None))
+
+    outputs = {
+        "show cdp neighbors": cdp_neighbors_output(synthetic_neighbors(hosts, index, fanout)),
+        "show interface status": interface_status_output(ports),
+        "show run | inc (interface)|switchport access vlan": interface_vlan_setting_output(settings),
+        "show mac address-table": mac_address_table_output(mac_entries),
+        "show vlan brief": vlan_brief_output(vlans),
+        "show run | inc monitor session": "",
+        "show env all": "FAN is OK\nTEMPERATURE is OK\nTemperature Value: 35 Degree Celsius\n"
+                        "Temperature State: GREEN\n"}
+    return outputs, arp
+
+
+def synthetic_network(hosts, ports_per_switch=48, fanout=4):
+    """ Produce the transcripts of a tree of switches for ReplayTelnet and start_fake_network, one for every
+        host. Every switch has an uplink to its parent on Gi1/0/49, downlinks on Gi1/1/x and one device per
+        edge port. The first host is the root and also answers show arp for all devices. """
+    vlans = [("1", "default"), ("10", "office"), ("11", "lab"), ("12", "voice"), ("13", "management")]
+    transcripts = {}
+    arp = []
+    for index, host in enumerate(hosts):
+        outputs, switch_arp = synthetic_switch_outputs(hosts, index, ports_per_switch, fanout, vlans)
+        transcripts[host] = {"hostname": "switch%03d" % index, "outputs": outputs}
+        arp.extend(switch_arp)
+    if hosts:
+        transcripts[hosts[0]]["outputs"]["show arp"] = arp_output(arp)
+    return transcripts
+
+
+class FakeIOSShell(object):
+    """ The command line of a (very) simple Cisco IOS switch, turning lines of input into output and prompts """
+
+    def __init__(self, hostname, outputs, config_lines=None):
+        self.hostname = hostname
+        self.outputs = outputs  # Output of show commands, keyed by command
+        self.config_lines = config_lines  # List to append the lines entered in configuration mode to, if any
+        self.mode = ""
+        self.question = False  # Whether the last output was a question instead of a prompt
+
+    def prompt(self):
+        """ The prompt for the current mode """
+        return self.hostname + self.mode + "#"
+
+    def respond(self, line):
+        """ Handle a line of input. Returns the output followed by the next prompt, or None to hang up. """
+        command = line.strip()
+        if self.question:
+            self.question = False
+            return "Building configuration...\n[OK]\n" + self.prompt()
+
+        if self.mode == "":
+            return self.respond_exec(command)
+        self.respond_config(command)
+        return self.prompt()
+
+    def respond_exec(self, command):
+        """ Handle a command in privileged EXEC mode, see respond """
+        output = ""
+        if command == "exit":
+            return None
+        elif command in ("config t", "conf t", "config terminal"):
+            self.mode = "(config)"
+        elif command.startswith("copy run"):
+            self.question = True
+            return "Destination filename [startup-config]? "
+        elif command.startswith("terminal "):
+            pass
+        elif command in self.outputs:
+            output = self.outputs[command]
+        elif command != "":
+            output = "% Invalid input detected at '^' marker.\n"
+        return output + self.prompt()
+
+    def respond_config(self, command):
+        """ Handle a command in one of the configuration modes, which only changes the mode """
+        if self.config_lines is not None:
+            self.config_lines.append(command)
+        if command == "end":
+            self.mode = ""
+        elif command == "exit":
+            self.mode = "(config)" if self.mode != "(config)" else ""
+        elif command.startswith("interface "):
+            self.mode = "(config-if)"
+        elif command.startswith("line "):
+            self.mode = "(config-line)"
+
+
+class FakeIOSHandler(SocketServer.BaseRequestHandler):
+    """ Handle a single telnet connection like a Cisco IOS switch would """
+
+    def __init__(self, request, client_address, server):
+        self.pending = ""  # Input received but not read yet
+        self.last_eol = ""  # The character that ended the previous line, to skip the other half of \r\n
+        SocketServer.BaseRequestHandler.__init__(self, request, client_address, server)  # Handles the connection
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Echo immediately, like IOS
+
+    def send(self, text):
+        """ Send text to the client """
+        self.request.sendall(text.replace("\n", "\r\n"))
+
+    def read_char(self):
+        """ Read a single character, emulating the input buffer of the device """
+        while self.pending == "":
+            data = self.request.recv(1024)
+            if data == "":
+                return None
+            max_burst = self.server.max_burst
+            if max_burst > 0 and len(data) > max_burst:
+                data = data[:max_burst]  # The device could not keep up and dropped the rest
+            self.pending = data
+        char = self.pending[0]
+        self.pending = self.pending[1:]
+        return char
+
+    def read_line(self, echo=True):
+        """ Read a line of input, echoing every character """
+        line = ""
+        while True:
+            char = self.read_char()
+            if char is None:
+                return None
+            if char == "\r" or char == "\n":
+                if line == "" and self.last_eol not in ("", char):
+                    self.last_eol = ""
+                    continue  # Second half of a \r\n pair
+                self.last_eol = char
+                if echo:
+                    self.send("\n")
+                return line
+            if char == "\0":
+                continue
+            if char == "\x15":
+                line = ""  # Ctrl-U erases the line typed so far
+                continue
+            line += char
+            if echo:
+                if self.server.echo_delay > 0:
+                    time.sleep(self.server.echo_delay)
+                self.request.sendall(char)
+
+    def login(self):
+        """ Perform the username/password dialog """
+        self.send("\nUser Access Verification\n\nUsername: ")
+        username = self.read_line()
+        self.send("Password: ")
+        password = self.read_line(echo=False)
+        if (username, password) != (self.server.username, self.server.password):
+            self.send("% Login invalid\n")
+            return False
+        return True
+
+    def handle(self):
+        if self.server.hang_up:
+            return
+        if not self.login():
+            return
+
+        shell = FakeIOSShell(self.server.hostname, self.server.outputs, self.server.config_lines)
+        self.send(shell.prompt())
+        while True:
+            line = self.read_line()
+            if line is None:
+                return
+            response = shell.respond(line)
+            if response is None:
+                return
+            if self.server.latency > 0:
+                time.sleep(self.server.latency)
+            self.send(response)
+
+
+class FakeIOSServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):  # pylint: disable=too-many-instance-attributes
+    """ A telnet server that behaves like a (very) simple Cisco IOS switch """
+
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, hostname, username="admin", password="admin"):
+        SocketServer.TCPServer.__init__(self, address, FakeIOSHandler)
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.outputs = {}  # Output of show commands, keyed by command
+        self.echo_delay = 0.0  # Seconds between echoed characters
+        self.latency = 0.0  # Seconds before answering a line, like the round trip to a remote device
+        self.max_burst = 0  # Drop input beyond this many characters per read, 0 to never drop
+        self.hang_up = False  # Close every connection right after accepting it
+        self.config_lines = []  # The lines entered in configuration mode, by all connections
+
+    def handle_error(self, request, client_address):
+        """ Clients hanging up is business as usual, only report other errors """
+        if sys is None:
+            return  # A connection thread outliving the interpreter, which has torn down the modules
+        if not isinstance(sys.exc_info()[1], socket.error):
+            SocketServer.TCPServer.handle_error(self, request, client_address)
+
+
+class ReplayTelnet(object):
+    """ Stands in for telnetlib.Telnet, answering like a FakeIOSServer from recorded transcripts instead of over
+        the network. Set CiscoTelnetSession.transport to this class to replay a network without any devices. """
+
+    transcripts = {}  # host -> {"hostname": name in the prompt, "outputs": output of show commands by command}
+    username = "admin"
+    password = "admin"
+    latency = 0.0  # Seconds before answering a line, like the round trip to a remote device
+
+    def __init__(self):
+        self.shell = None
+        self.output = ""
+        self.input = ""
+        self.login_state = None  # "username" or "password" while logging in
+        self.login_username = None
+        self.closed = True
+
+    def open(self, host, port=0, timeout=None):  # pylint: disable=unused-argument
+        """ Connect to the recorded device host """
+        transcript = self.transcripts.get(host)
+        if transcript is None:
+            raise socket.error(errno.ECONNREFUSED, "No transcript for " + host)
+        self.shell = FakeIOSShell(transcript["hostname"], transcript["outputs"])
+        self.closed = False
+        self.login_state = "username"
+        self.send("\nUser Access Verification\n\nUsername: ")
+
+    def close(self):
+        """ Hang up """
+        self.closed = True
+        self.output = ""
+
+    def send(self, text):
+        """ Queue text for reading, like the device sent it """
+        self.output += text.replace("\n", "\r\n")
+
+    def write(self, data):
+        """ Type data, echoing it and answering every complete line right away """
+        if self.closed:
+            raise socket.error(errno.EPIPE, "Connection closed")
+        data = data.replace("\r", "")
+        while data != "":
+            text, newline, data = data.partition("\n")
+            if "\x15" in text:
+                self.input = ""  # Ctrl-U erases the line typed so far
+                text = text.rpartition("\x15")[2]
+            self.input += text
+            if self.login_state != "password":
+                self.send(text + newline)
+            if newline != "":
+                line = self.input
+                self.input = ""
+                self.receive(line)
+
+    def receive(self, line):
+        """ Handle a complete line of input """
+        if self.login_state == "username":
+            self.login_username = line
+            self.login_state = "password"
+            self.send("Password: ")
+        elif self.login_state == "password":
+            self.login_state = None
+            if (self.login_username, line) != (self.username, self.password):
+                self.send("% Login invalid\n")
+                self.closed = True
+                return
+            self.send(self.shell.prompt())
+        else:
+            response = self.shell.respond(line)
+            if response is None:
+                self.closed = True
+                return
+            if self.latency > 0:
+                time.sleep(self.latency)
+            self.send(response)
+
+    def take(self, length):
+        """ Remove length characters from the output and return them. Like telnetlib, raises EOFError when the
+            connection is closed and nothing is left to read. """
+        if self.closed and self.output == "":
+            raise EOFError("telnet connection closed")
+        text = self.output[:length]
+        self.output = self.output[length:]
+        return text
+
+    def read_until(self, match, timeout=None):  # pylint: disable=unused-argument
+        """ Read until match, or everything there is. All output is there already, so this never waits. """
+        index = self.output.find(match)
+        if index == -1:
+            return self.take(len(self.output))
+        return self.take(index + len(match))
+
+    def read_very_eager(self):
+        """ Read everything there is """
+        return self.take(len(self.output))
+
+    def expect(self, regexes, timeout=None):  # pylint: disable=unused-argument
+        """ Read until one of regexes matches, like telnetlib.Telnet.expect """
+        for index, regex in enumerate(regexes):
+            if not hasattr(regex, "search"):
+                regex = re.compile(regex)
+            match = regex.search(self.output)
+            if match is not None:
+                return index, match, self.take(match.end())
+        return -1, None, self.take(len(self.output))
+
+
+def start_fake_ios(hostname, port=0, username="admin", password="admin", address="127.0.0.1"):  # pylint: disable=too-many-arguments
+    """ Start a FakeIOSServer in a background thread and return it """
+    server = FakeIOSServer((address, port), hostname, username, password)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def start_fake_network(transcripts, port=0, latency=0.0, echo_delay=0.0):
+    """ Start a FakeIOSServer for every host in transcripts, which have to be local addresses like 127.0.1.1.
+        All servers listen on the same port, a free one if port is 0. Returns the servers. """
+    servers = []
+    for host in sorted(transcripts):
+        server = start_fake_ios(transcripts[host]["hostname"], port, address=host)
+        server.outputs = transcripts[host]["outputs"]
+        server.latency = latency
+        server.echo_delay = echo_delay
+        port = server.server_address[1]
+        servers.append(server)
+    return servers
+
+
+def stop_fake_network(servers):
+    """ Stop the servers started by start_fake_network, all at once """
+    threads = [threading.Thread(target=server.shutdown) for server in servers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for server in servers:
+        server.server_close()
+
+
+def recorded_commands():
+    """ The show commands of all parsers which don't need an argument """
+    return sorted(parser.command for name, parser in CiscoTelnetSession.parsers.items()
+                  if getattr(CiscoTelnetSession, name).__code__.co_argcount == 1)
+
+
+def record_transcripts(switchset, commands=None):
+    """ Record the output of commands (by default recorded_commands) on every device of switchset, in the form
+        ReplayTelnet replays """
+    if commands is None:
+        commands = recorded_commands()
+    transcripts = {}
+    for host in sorted(switchset.seen):
+        if host in switchset.blacklist:
+            continue
+        session = switchset.sessions.acquire(host)
+        if session is None:
+            sys.stderr.write("record_transcripts: failed to connect to " + host + "\n")
+            continue
+        outputs = {}
+        healthy = False
+        try:
+            for command in commands:
+                output = session.execute_command(command).replace("\r\n", "\n")
+                outputs[command] = output.partition("\n")[2]  # Without the echoed command
+            healthy = True
+        finally:
+            switchset.sessions.release(host, session, healthy)
+        transcripts[host] = {"hostname": session.prompt[:-1], "outputs": outputs}
+    return transcripts
+
+
+def save_transcripts(transcripts, filename):
+    """ Save transcripts to a json file """
+    with open(filename, "w") as fd:
+        json.dump(transcripts, fd, indent=1, sort_keys=True)
+
+
+def load_transcripts(filename):
+    """ Load transcripts saved by save_transcripts """
+    with open(filename, "r") as fd:
+        json_decoded = json.load(fd)
+    transcripts = {}
+    for host, transcript in json_decoded.items():
+        # Like a telnet connection, the sessions work with byte strings
+        outputs = dict((str(command), str(output)) for command, output in transcript["outputs"].items())
+        transcripts[str(host)] = {"hostname": str(transcript["hostname"]), "outputs": outputs}
+    return transcripts
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.stderr.write("Usage: " + sys.argv[0] + " hostname port\n")
+        sys.exit(-1)
+
+    main_server = FakeIOSServer(("127.0.0.1", int(sys.argv[2])), sys.argv[1])
+    try:
+        main_server.serve_forever()
+    except (KeyboardInterrupt, socket.error):
+        pass
+    sys.exit(0)
@@ -4,39 +4,119 @@ import sys
 import json
 
 
-from Cisco import CiscoTelnetSession, CiscoSet
+from Cisco import CiscoTelnetSession, CiscoSet, ConnectionFailed
+from Cisco import execute_on_pooled_device
+from network_index import NetworkIndex
 
 telnet_port = 23
-
-def get_port_patchid(port_list, hostname_switch, switch_port):
-    """ Look up the patchid of a port """
-    for cur_port in port_list:
-        if cur_port["interface"] == switch_port and cur_port["hostname"] == hostname_switch:
-            return cur_port["patchid"]
+max_hops = 16
+
+
+def get_cached_index(switchset, switch_hostname):
+    """ Build a NetworkIndex from whatever the topology cache holds, regardless of its age """
+    index = NetworkIndex(vlans=switchset.cache.get(switch_hostname, "show_vlan"))
+    for host in switchset.seen:
+        index.add_ports(switchset.cache.get(host, "get_interface_status_and_setting") or
+                        switchset.cache.get(host, "show_interface_vlan") or [])
+        index.add_mac_addresses(switchset.cache.get(host, "show_mac_address_table") or [])
+    return index
+
+
+def find_ip_mac(switchset, router_hostname, ip):
+    """ Look up the mac address of ip, in the cached ARP table of the router if it's fresh, or else on the router """
+    arp = []
+    if not switchset.cache.is_stale(router_hostname, "show_arp"):
+        arp = [arp_entry for arp_entry in switchset.cache.get(router_hostname, "show_arp") if arp_entry["ip"] == ip]
+    if len(arp) == 0:
+        try:
+            arp = execute_on_pooled_device(switchset.sessions, router_hostname, "show_arp_ip", ip)
+        except ConnectionFailed:
+            return None
+    for arp_entry in arp:
+        if arp_entry["ip"] == ip:
+            return arp_entry["macaddress"]
     return None
 
 
-def get_vlan_name(vlan_list, vlan_id):
-    """ Look up the vlan name by the vlan id, in a list returned by the switch """
-    for vlan in vlan_list:
-        if vlan["vlanid"] == str(vlan_id):
-            return vlan["vlanname"]
+def find_mac_on_switch(switchset, host, macaddress):
+    """ Ask a single switch where it sees macaddress, return the mac address table entry or None """
+    try:
+        mac_entries = execute_on_pooled_device(switchset.sessions, host, "show_mac_address_table_address", macaddress)
+    except ConnectionFailed:
+        return None
+    if not mac_entries:
+        return None
+    return mac_entries[0]
+
+
+def trace_mac(switchset, start_hostname, macaddress, index):
+    """ Follow macaddress from start_hostname along the CDP neighbors, asking one switch per hop. Returns the mac
+        address table entries along the path, the port the device is connected to last. Tries the port in the
+        cached mac address tables first, the one with the least mac addresses first, which needs a single switch
+        if the device didn't move. """
+    links = {}  # (hostname, interface) -> neighbor hostname
+    for link in switchset.adjacency:
+        links[(link["hostname"], link["interface"])] = link["deviceid"]
+
+    # Uplinks to devices without CDP, and port-channels, aren't in the adjacency. Like full_trace, trust the port
+    # with the least mac addresses most.
+    candidates = sorted(index.find_mac_address(macaddress),
+                        key=lambda mac_entry: index.count_mac_addresses(mac_entry["hostname"], mac_entry["port"]))
+    for mac_entry in candidates:
+        if (mac_entry["hostname"], mac_entry["port"]) in links:
+            continue  # Seen on an uplink, not where the device is connected
+        current = find_mac_on_switch(switchset, mac_entry["hostname"], macaddress)
+        if current is not None and current["port"] == mac_entry["port"]:
+            return [current]
+
+    path = []
+    host = start_hostname
+    while host is not None and len(path) < max_hops and host not in [hop["hostname"] for hop in path]:
+        mac_entry = find_mac_on_switch(switchset, host, macaddress)
+        if mac_entry is None:
+            break
+        path.append(mac_entry)
+        host = links.get((host, mac_entry["port"]))
+    return path
+
+
+def full_trace(switchset, router_hostname, switch_hostname, ip):
+    """ Find ip by getting the ARP table, and the mac address tables and ports of all devices """
+    arp = switchset.execute_on_hosts_cached([router_hostname], CiscoTelnetSession.show_arp)
+    vlans = switchset.execute_on_hosts_cached([switch_hostname], CiscoTelnetSession.show_vlan)
+
+    mac = switchset.execute_on_all(CiscoTelnetSession.show_mac_address_table)
+    all_ports = switchset.execute_on_all(CiscoTelnetSession.show_interface_vlan)
+
+    ip_mac = "0000.0000.0000"
+    for arp_entry in arp:
+        arp_entry_ip = arp_entry["ip"]
+        arp_entry_mac = arp_entry["macaddress"]
+        if arp_entry_ip == ip:
+            ip_mac = arp_entry_mac
+
+    index = NetworkIndex(all_ports, vlans, mac)
+    results = annotate(index.find_mac_address(ip_mac), index)
+    return sorted(results, key=lambda k: k['uncertainty'])
 
 
-def count_mac_addresses(mac_addresses, hostname, switch_port):
-    """ Count the number of mac addresses seen on a single port """
-    count = 0
-    for cur_mac_entry in mac_addresses:
-        if cur_mac_entry["hostname"] == hostname and cur_mac_entry["port"] == switch_port:
-            count = count + 1
-    return count
+def annotate(mac_entries, index):
+    """ Add uncertainty, vlan name and patchid to mac address table entries """
+    results = []
+    for mac_entry in mac_entries:
+        mac_entry.pop("macaddress_type", None)  # Remove uninteresting info before printing
+        mac_entry["uncertainty"] = index.count_mac_addresses(mac_entry["hostname"], mac_entry["port"])
+        mac_entry["vlanname"] = index.get_vlan_name(mac_entry["vlanid"])
+        mac_entry["patchid"] = index.get_port_patchid(mac_entry["hostname"], mac_entry["port"])
+        results.append(mac_entry)
+    return results
 
 
 if __name__ == '__main__':
     # This block initializes some variables depending on how we were called
     if len(sys.argv) < 6:
         sys.stderr.write("Usage: " + sys.argv[0] +
-                         " username password the-missing-IP router switch\n")
+                         " username password the-missing-IP router switch [full]\n")
         sys.exit(-1)
 
     username = str(sys.argv[1])
@@ -44,40 +124,26 @@ if __name__ == '__main__':
     ip = str(sys.argv[3])
     router_hostname = str(sys.argv[4])
     switch_hostname = str(sys.argv[5])
+    full = len(sys.argv) > 6 and sys.argv[6] == "full"
     port = 23
 
-    router = CiscoTelnetSession()
-    router.open(router_hostname, port, username, password)
-    arp = router.show_arp()
-
     switchset = CiscoSet(username, password, switch_hostname, port)
-    switchset.discover_devices()
-
-    vlan_switch = CiscoTelnetSession()
-    vlan_switch.open(switch_hostname, port, username, password)
-    vlans = vlan_switch.show_vlan()
+    switchset.load()
+    if full or len(switchset.adjacency) == 0:
+        switchset.discover_devices()
+
+    sorted_results = []
+    if not full:
+        ip_mac = find_ip_mac(switchset, router_hostname, ip)
+        if ip_mac is not None:
+            # The edge port comes last in the path, the uncertainty is only known for ports in the cached tables
+            index = get_cached_index(switchset, switch_hostname)
+            path = trace_mac(switchset, switch_hostname, ip_mac, index)
+            sorted_results = annotate(list(reversed(path)), index)
+    if len(sorted_results) == 0:
+        sys.stderr.write("Tracing %s along the neighbors failed, querying all devices\n" % ip)
+        sorted_results = full_trace(switchset, router_hostname, switch_hostname, ip)
 
-    mac = switchset.execute_on_all(CiscoTelnetSession.show_mac_address_table)
-    all_ports = switchset.execute_on_all(CiscoTelnetSession.show_interface_vlan)
-
-    ip_mac = "0000.0000.0000"
-    for arp_entry in arp:
-        arp_entry_ip = arp_entry["ip"]
-        arp_entry_mac = arp_entry["macaddress"]
-        if arp_entry_ip == ip:
-            ip_mac = arp_entry_mac
-
-    results = []
-    for mac_entry in mac:
-        if mac_entry["macaddress"] == ip_mac:
-            mac_entry.pop("macaddress_type")  # Remove uninteresting info before printing
-            mac_entry["uncertainty"] = count_mac_addresses(
-                mac, mac_entry["hostname"], mac_entry["port"])
-            mac_entry["vlanname"] = get_vlan_name(vlans, mac_entry["vlanid"])
-            mac_entry["patchid"] = get_port_patchid(
-                all_ports, mac_entry["hostname"], mac_entry["port"])
-            results.append(mac_entry)
-
-    sorted_results = sorted(results, key=lambda k: k['uncertainty'])
     json_result = json.dumps(sorted_results)
     print json_result
+    switchset.close()
@@ -0,0 +1,165 @@
+#/usr/bin/env python
+#
+# Copyright (C) 2016-2017 DNW German-Dutch Wind Tunnels
+#
+# This file is part of nettools.
+# Nettools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with nettools.  If not, see <http://www.gnu.org/licenses/>.
+""" This module defines the MacJournal class, which records where mac addresses come and go between runs """
+
+import json
+import time
+import sys
+import re
+
+from atomic_file import write_atomic
+
+journal_fields = ("time", "event", "macaddress", "vlanid", "hostname", "port", "ip")
+
+
+def normalize_macaddress(macaddress):
+    """ Convert a mac address in any common notation (00:11:22:33:44:55, 00-11-..., 0011.2233.4455) to the
+        notation of IOS """
+    digits = re.sub("[^0-9a-f]", "", macaddress.lower())
+    return ".".join(digits[i:i + 4] for i in range(0, len(digits), 4))
+
+
+def arp_vlanid(arp_entry):
+    """ Get the VLAN id of an ARP entry from its interface, e.g. 10 for Vlan10 """
+    interface = arp_entry["vlanname"]
+    if interface.lower().startswith("vlan"):
+        return interface[4:]
+    return interface
+
+
+def locations(mac_entries, arp_entries):
+    """ Find where every (macaddress, vlanid) is connected, as (hostname, port, ip). A mac address is seen on
+        every switch between the device and the router, the port with the least mac addresses on it is taken to
+        be the one the device is connected to. Mac addresses only seen in ARP have no hostname and port. """
+    counts = {}  # (hostname, port) -> number of mac addresses
+    for mac_entry in mac_entries:
+        port = (mac_entry["hostname"], mac_entry["port"])
+        counts[port] = counts.get(port, 0) + 1
+
+    ports = {}  # (macaddress, vlanid) -> (number of mac addresses, hostname, port)
+    for mac_entry in mac_entries:
+        key = (mac_entry["macaddress"], mac_entry["vlanid"])
+        port = (counts[(mac_entry["hostname"], mac_entry["port"])], mac_entry["hostname"], mac_entry["port"])
+        ports[key] = min(ports.get(key, port), port)  # Ties are broken by name, so a device doesn't seem to move
+
+    ips = {}  # (macaddress, vlanid) -> list of ips
+    for arp_entry in arp_entries:
+        ips.setdefault((arp_entry["macaddress"], arp_vlanid(arp_entry)), []).append(arp_entry["ip"])
+
+    result = {}
+    for key in set(ports) | set(ips):
+        _, hostname, port = ports.get(key, (0, "", ""))
+        result[key] = (hostname, port, ",".join(sorted(ips.get(key, []))))
+    return result
+
+
+class MacJournal(object):
+    """ Keeps the location of every (macaddress, vlanid) of the previous run, and appends only the added, removed
+        and moved ones to a journal file. A move is a new port, or a new ip. Every line of the journal holds a
+        tab separated time, event, macaddress, vlanid, hostname, port and ip; for removed entries the last known
+        location. """
+
+    # Seconds an entry has to be missing before it is removed, so devices that are quiet for a while and age
+    # out of the mac address tables don't fill the journal
+    removal_delay = 3600
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.state_filename = filename + ".state"
+        self.entries = {}  # (macaddress, vlanid) -> [hostname, port, ip, last seen]
+
+    def load(self):
+        """ Load the locations of the previous run, return whether they were found """
+        try:
+            with open(self.state_filename, "r") as fd:
+                json_decoded = json.load(fd)
+        except (IOError, ValueError):
+            return False
+        self.entries = dict((tuple(key.split(" ")), entry) for key, entry in json_decoded.items())
+        return True
+
+    def save(self):
+        """ Save the locations, see write_atomic """
+        write_atomic(self.state_filename, json.dumps(dict(("%s %s" % key, entry) for key, entry in self.entries.items())))
+
+    def diff(self, current, now):
+        """ Compare the current locations with the previous ones, and remember the current ones. Returns the
+            changes as (event, (macaddress, vlanid), (hostname, port, ip)). """
+        changes = []
+        for key, location in current.items():
+            entry = self.entries.get(key)
+            if entry is not None and location[0] == "":
+                location = (entry[0], entry[1], location[2])  # Only aged out of the mac address tables, keep its port
+            if entry is None:
+                changes.append(("added", key, location))
+            elif tuple(entry[:3]) != location:
+                changes.append(("moved", key, location))
+            self.entries[key] = list(location) + [now]
+
+        for key, entry in self.entries.items():
+            if key not in current and now - entry[3] > self.removal_delay:
+                changes.append(("removed", key, tuple(entry[:3])))
+                del self.entries[key]
+        return sorted(changes, key=lambda change: change[1])
+
+    def update(self, mac_entries, arp_entries, now=None):
+        """ Track the results of show_mac_address_table and show_arp: append the changes since the previous
+            run to the journal and save the new locations. Returns the changes, see diff. """
+        if now is None:
+            now = time.time()
+        changes = self.diff(locations(mac_entries, arp_entries), now)
+        with open(self.filename, "a") as fd:
+            for event, (macaddress, vlanid), (hostname, port, ip) in changes:
+                fd.write("%d\t%s\t%s\t%s\t%s\t%s\t%s\n" % (now, event, macaddress, vlanid, hostname, port, ip))
+        self.save()
+        return changes
+
+
+def read_journal(filename, macaddress=None, since=0):
+    """ Read the changes in a journal as dicts with the journal_fields, optionally only those of macaddress
+        and those after since. The changes after since are preceded by the last change before since of every
+        (macaddress, vlanid), which tells where it was at since. """
+    earlier = {}  # (macaddress, vlanid) -> last change before since
+    with open(filename, "r") as fd:
+        for line in fd:
+            if macaddress is not None and macaddress not in line:
+                continue  # Cheap test first, most lines are about other mac addresses
+            change = dict(zip(journal_fields, line.rstrip("\n").split("\t")))
+            change["time"] = int(change["time"])
+            if macaddress is not None and change["macaddress"] != macaddress:
+                continue
+            if change["time"] < since:
+                earlier[(change["macaddress"], change["vlanid"])] = change
+                continue
+            for key in sorted(earlier):
+                yield earlier[key]
+            earlier = {}
+            yield change
+    for key in sorted(earlier):
+        yield earlier[key]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.stderr.write("Usage: " + sys.argv[0] + " journal-file macaddress [days]	to show where macaddress was\n")
+        sys.exit(-1)
+
+    main_macaddress = normalize_macaddress(sys.argv[2])
+    main_since = time.time() - float(sys.argv[3]) * 24 * 3600 if len(sys.argv) > 3 else 0
+    print json.dumps(list(read_journal(sys.argv[1], main_macaddress, main_since)))
+    sys.exit(0)
@@ -2,7 +2,7 @@
 """ This file is the main routine for finding IPs in a Cisco-based network """
 import sys
 
-from Cisco import CiscoTelnetSession, CiscoSet
+from Cisco import CiscoSet
 
 telnet_port = 23
 
@@ -20,10 +20,9 @@ if __name__ == '__main__':
 
     switchset = CiscoSet(username, password, switch_hostname, port)
     switchset.discover_devices()
-
-    neighbors = switchset.execute_on_all(CiscoTelnetSession.show_neighbors)
+    switchset.close()
 
     print "digraph \"" + switch_hostname + "\" {"
-    for neighbor in neighbors:
+    for neighbor in switchset.adjacency:
         print "\"" + neighbor["hostname"] + "\" -> \"" + neighbor["deviceid"] + "\";"
     print "}"
@@ -0,0 +1,74 @@
+#/usr/bin/env python
+#
+# Copyright (C) 2016-2017 DNW German-Dutch Wind Tunnels
+#
+# This file is part of nettools.
+# Nettools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with nettools.  If not, see <http://www.gnu.org/licenses/>.
+""" This module defines the NetworkIndex class, for joining the results of show commands """
+
+
+class NetworkIndex(object):
+    """ Hash indexes over ports, VLANs and MAC address entries, so they can be joined in linear time """
+
+    def __init__(self, ports=None, vlans=None, mac_addresses=None):
+        self.ports = {}  # (hostname, interface) -> port
+        self.vlans = {}  # vlanid -> vlan
+        self.mac_addresses = {}  # macaddress -> list of mac address entries
+        self.mac_counts = {}  # (hostname, port) -> number of mac address entries
+        self.add_ports(ports or [])
+        self.add_vlans(vlans or [])
+        self.add_mac_addresses(mac_addresses or [])
+
+    def add_ports(self, ports):
+        """ Index ports, as returned by show_interface_vlan or get_interface_status_and_setting """
+        for port in ports:
+            self.ports.setdefault((port["hostname"], port["interface"]), port)
+
+    def add_vlans(self, vlans):
+        """ Index VLANs, as returned by show_vlan """
+        for vlan in vlans:
+            self.vlans.setdefault(str(vlan["vlanid"]), vlan)
+
+    def add_mac_addresses(self, mac_addresses):
+        """ Index mac address entries, as returned by show_mac_address_table """
+        for mac_entry in mac_addresses:
+            self.mac_addresses.setdefault(mac_entry["macaddress"], []).append(mac_entry)
+            key = (mac_entry["hostname"], mac_entry["port"])
+            self.mac_counts[key] = self.mac_counts.get(key, 0) + 1
+
+    def get_port(self, hostname, interface):
+        """ Look up a port by switch and interface """
+        return self.ports.get((hostname, interface))
+
+    def get_port_patchid(self, hostname, interface):
+        """ Look up the patchid of a port """
+        port = self.ports.get((hostname, interface))
+        if port is None:
+            return None
+        return port["patchid"]
+
+    def get_vlan_name(self, vlan_id):
+        """ Look up the vlan name by the vlan id """
+        vlan = self.vlans.get(str(vlan_id))
+        if vlan is None:
+            return None
+        return vlan["vlanname"]
+
+    def count_mac_addresses(self, hostname, port):
+        """ Count the number of mac addresses seen on a single port """
+        return self.mac_counts.get((hostname, port), 0)
+
+    def find_mac_address(self, macaddress):
+        """ Return all mac address entries for macaddress """
+        return self.mac_addresses.get(macaddress, [])
@@ -2,40 +2,96 @@
 """ This file is the main routine for finding IPs in a Cisco-based network """
 import sys
 import json
+import os
+import shutil
+import tempfile
+import time
 
 from Cisco import CiscoTelnetSession, CiscoSet
+from network_index import NetworkIndex
+from mac_journal import MacJournal
+from atomic_file import write_atomic
 
 telnet_port = 23
 
 
-def get_port_patchid(port_list, hostname_switch, switch_port):
-    """ Look up the patchid of a port """
-    for cur_port in port_list:
-        if cur_port["interface"] == switch_port and cur_port["hostname"] == hostname_switch:
-            return cur_port["patchid"]
-    return None
-
-
-def get_vlan_name(vlan_list, vlan_id):
-    """ Look up the vlan name by the vlan id, in a list returned by the switch """
-    for vlan in vlan_list:
-        if vlan["vlanid"] == str(vlan_id):
-            return vlan["vlanname"]
+def get_network_overview(switchset, router_hostname, switch_hostname):
+	"""Collect the arp, mac, ports, vlans, rspan and neighbors of the network in a dict"""
+	switchset.discover_devices()
 
+	# Everything below comes from the topology cache, only stale entries are fetched from the devices
+	arp = switchset.execute_on_hosts_cached([router_hostname], CiscoTelnetSession.show_arp)
+	vlans = switchset.execute_on_hosts_cached([switch_hostname], CiscoTelnetSession.show_vlan)
 
-def count_mac_addresses(mac_addresses, hostname, switch_port):
-    """ Count the number of mac addresses seen on a single port """
-    count = 0
-    for cur_mac_entry in mac_addresses:
-        if cur_mac_entry["hostname"] == hostname and cur_mac_entry["port"] == switch_port:
-            count = count + 1
-    return count
+	# Core switches have tens of thousands of mac addresses, parse them while they arrive
+	mac = switchset.execute_on_all_cached(CiscoTelnetSession.show_mac_address_table, CiscoTelnetSession.stream_mac_address_table)
+	all_ports = switchset.execute_on_all_cached(CiscoTelnetSession.get_interface_status_and_setting)
+	index = NetworkIndex(all_ports, vlans, mac)
+	for port in all_ports:
+		try:
+			port["vlanname"] = index.get_vlan_name(port["vlanid"])
+			port["vlanconfigname"] = index.get_vlan_name(port["vlanconfig"])
+		except KeyError:
+			pass
 
+	for mac_entry in mac:
+		mac_entry.pop("macaddress_type") #Remove uninteresting info before printing
+		mac_entry["uncertainty"] = index.count_mac_addresses(mac_entry["hostname"], mac_entry["port"])
+		mac_entry["vlanname"] = index.get_vlan_name(mac_entry["vlanid"])
+		mac_entry["patchid"] = index.get_port_patchid(mac_entry["hostname"], mac_entry["port"])
+
+	rspan = switchset.execute_on_all_cached(CiscoTelnetSession.show_span)
+
+	neighbors = switchset.execute_on_all_cached(CiscoTelnetSession.show_neighbors)
+
+	return { "arp" : arp, "mac" : mac, "ports" : all_ports, "vlans" : vlans, "rspan" : rspan, "neighbors" : neighbors}
+
+def build_lookup(overview):
+	"""Index the mac entries of an overview by IP and by mac address, most certain entries first"""
+	by_mac = {}
+	for mac_entry in overview["mac"]:
+		by_mac.setdefault(mac_entry["macaddress"], []).append(mac_entry)
+	for mac_entries in by_mac.values():
+		mac_entries.sort(key=lambda mac_entry: mac_entry["uncertainty"])
+
+	by_ip = {}
+	for arp_entry in overview["arp"]:
+		macaddress = arp_entry["macaddress"]
+		by_ip[arp_entry["ip"]] = { "ip" : arp_entry["ip"], "macaddress" : macaddress, "mac" : by_mac.get(macaddress, [])}
+	return by_ip, by_mac
+
+def write_snapshot(overview, directory):
+	"""Write networkOverview.json and the lookup/ip/<ip>.json and lookup/mac/<mac>.json files to directory.
+	The lookup tree is built next to the old one and swapped in, so the web pages only need to read a single small file."""
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	by_ip, by_mac = build_lookup(overview)
+
+	lookup_dir = os.path.join(directory, "lookup")
+	work_dir = tempfile.mkdtemp(prefix="lookup.", suffix=".tmp", dir=directory) # Unique, and removed even if this round fails
+	temp_dir = os.path.join(work_dir, "new")
+	old_dir = os.path.join(work_dir, "old")
+	try:
+		for subdir, entries in [("ip", by_ip), ("mac", by_mac)]:
+			os.makedirs(os.path.join(temp_dir, subdir))
+			for key, entry in entries.items():
+				with open(os.path.join(temp_dir, subdir, key + ".json"), "w") as fd:
+					fd.write(json.dumps(entry))
+
+		if os.path.isdir(lookup_dir):
+			os.rename(lookup_dir, old_dir)
+		os.rename(temp_dir, lookup_dir)
+	finally:
+		shutil.rmtree(work_dir, True)
+
+	write_atomic(os.path.join(directory, "networkOverview.json"), json.dumps(overview))
 
 if __name__ == '__main__':
 	#This block initializes some variables depending on how we were called
 	if len(sys.argv) < 5:
-		sys.stderr.write("Usage: " + sys.argv[0] + " username password router switch\n")
+		sys.stderr.write("Usage: " + sys.argv[0] + " username password router switch				to print the overview\n")
+		sys.stderr.write("Usage: " + sys.argv[0] + " username password router switch directory			to write a snapshot to directory, and the changes since the last one to directory/macJournal.tsv\n")
+		sys.stderr.write("Usage: " + sys.argv[0] + " username password router switch directory interval	to rewrite it every interval seconds\n")
 		sys.exit(-1)
 
 	username	= str(sys.argv[1])
@@ -43,42 +99,31 @@ if __name__ == '__main__':
 	router_hostname	= str(sys.argv[3])
 	switch_hostname	= str(sys.argv[4])
 	port = 23
-
-
-
-	router = CiscoTelnetSession()
-	router.open(router_hostname, port, username, password)
-	arp = router.show_arp()
+	directory = sys.argv[5] if len(sys.argv) > 5 else None
+	interval = int(sys.argv[6]) if len(sys.argv) > 6 else None
 
 	switchset = CiscoSet(username, password, switch_hostname, port)
-	switchset.discover_devices()
 
-	vlan_switch = CiscoTelnetSession()
-	vlan_switch.open(switch_hostname, port, username, password)
-	vlans = vlan_switch.show_vlan()
+	if directory is None:
+		print json.dumps(get_network_overview(switchset, router_hostname, switch_hostname))
+		switchset.close()
+		sys.exit(0)
 
-	mac = switchset.execute_on_all(CiscoTelnetSession.show_mac_address_table)
-	all_ports = switchset.execute_on_all(CiscoTelnetSession.get_interface_status_and_setting)
-	for port in all_ports:
+	journal = MacJournal(os.path.join(directory, "macJournal.tsv"))
+	journal.load()
+	while True:
+		start = time.time()
 		try:
-			port["vlanname"] = get_vlan_name(vlans, port["vlanid"])
-			port["vlanconfigname"] = get_vlan_name(vlans, port["vlanconfig"])
-		except KeyError:
-			pass
-
-	port_settings = switchset.execute_on_all(CiscoTelnetSession.get_interface_vlan_setting)
-	for port_setting in port_settings:
-		port_setting["interface"] = CiscoTelnetSession.fix_interfacename(port_setting["interface"])
-
-	for mac_entry in mac:
-		mac_entry.pop("macaddress_type") #Remove uninteresting info before printing
-		mac_entry["uncertainty"] = count_mac_addresses(mac, mac_entry["hostname"], mac_entry["port"])
-		mac_entry["vlanname"] = get_vlan_name(vlans, mac_entry["vlanid"])
-		mac_entry["patchid"] = get_port_patchid(all_ports, mac_entry["hostname"], mac_entry["port"])
-	    
-	rspan = switchset.execute_on_all(CiscoTelnetSession.show_span)
-
-	neighbors = switchset.execute_on_all(CiscoTelnetSession.show_neighbors)
-
-	json_list = { "arp" : arp, "mac" : mac, "ports" : all_ports, "vlans" : vlans, "rspan" : rspan, "neighbors" : neighbors}
-	print json.dumps(json_list)
+			overview = get_network_overview(switchset, router_hostname, switch_hostname)
+			write_snapshot(overview, directory)
+			changes = journal.update(overview["mac"], overview["arp"])
+			sys.stderr.write("Wrote snapshot to %s in %.1f s, %d mac address changes\n" % (directory, time.time() - start, len(changes)))
+		except Exception as e: # pylint: disable=broad-except
+			if interval is None:
+				raise
+			sys.stderr.write("Failed to write snapshot: %s\n" % e) # Keep the previous snapshot, try again next time
+		switchset.save_statistics(switchset.get_statistics_filename("prom")) # The command timing so far, for monitoring
+		if interval is None:
+			break
+		time.sleep(max(0, interval - (time.time() - start)))
+	switchset.close()
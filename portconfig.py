@@ -19,9 +19,12 @@
 
 import sys
 import socket
+import threading
 
 from Cisco import CiscoTelnetSession
 from Cisco import CiscoSet
+from Cisco import ConnectionFailed
+from Cisco import execute_on_pooled_device
 
 
 my_fqdn = socket.getfqdn()
@@ -32,6 +35,10 @@ telnet_port = 23
 # Patchlist stuff
 patchlist_patchid_column = "Patchnr"
 
+# VLANs which aren't reported by the switches
+dynamic_vlan = {'vlanname': 'dynamic', 'vlanid': 'dynamic', 'status': 'software-generated'}
+trunk_vlan = {'vlanname': 'trunk', 'vlanid': 'trunk', 'status': 'software-generated'}
+
 # Init global vars
 main_patchnumber = None
 main_vlanname = None
@@ -58,7 +65,7 @@ def connect_to_switch(hostname, port, username, password):
 
 def fix_patchid(patchid):
     """ Fix common errors in a patchid """
-    patchid.replace(".", "-")
+    patchid = patchid.replace(".", "-")
     elements = patchid.split("-")
     new_elements = []
     for element in elements:
@@ -71,22 +78,74 @@ def fix_patchid(patchid):
     return patchid_corrected
 
 
+def set_switchlist(switchset, timeout=None):
+    """ Make switchset the CiscoSet of the network, closing the workers and sessions of the previous one. Waits at
+        most timeout seconds for the commands still running on the previous one. """
+    global switchlist
+    if switchlist is not None and switchlist is not switchset:
+        switchlist.close(timeout)
+    switchlist = switchset
+
+
+def get_switchlist(hostname, port, username, password):
+    """ Get the CiscoSet of the network, as found by the last discovery, without rediscovering it """
+    if switchlist is None:
+        switchset = CiscoSet(username, password, hostname, port)
+        switchset.load()
+        set_switchlist(switchset)
+    return switchlist
+
+
+def build_patchid_index(ports):
+    """ Map the (fixed) patchid of every port to the port """
+    index = {}
+    for port in ports:
+        index.setdefault(fix_patchid(port["patchid"]), port)
+    return index
+
+
+def get_cached_patchports(switchset):
+    """ Get all patchports in the topology cache, regardless of their age """
+    all_ports = []
+    for host in switchset.seen:
+        all_ports.extend(switchset.cache.get(host, "get_interface_status_and_setting") or [])
+    return all_ports
+
+
+def verify_patchport(switchset, patchport):
+    """ Check a patchport against its switch, querying only that port. Returns the current state of the port,
+        or None if the patchid isn't on that port anymore. """
+    switch_hostname = patchport["hostname"]
+    try:
+        port = execute_on_pooled_device(switchset.sessions, switch_hostname, "show_interface_status",
+                                        patchport["interface"])
+        if port is None or fix_patchid(port["patchid"]) != fix_patchid(patchport["patchid"]):
+            return None
+        setting = execute_on_pooled_device(switchset.sessions, switch_hostname, "show_run_interface",
+                                           patchport["interface"])
+    except ConnectionFailed:
+        return None
+    if setting is not None and setting["vlanconfig"] is not None:
+        port["vlanconfig"] = setting["vlanconfig"]
+    return port
+
+
 def get_available_patchports(hostname, port, username, password):
     """ Get all available patchports """
-    global switchlist
-    switchlist = CiscoSet(username, password, hostname, port)
-    switchlist.discover_devices()
-    all_ports = switchlist.execute_on_all(CiscoTelnetSession.get_interface_status_and_setting)
+    switchset = CiscoSet(username, password, hostname, port)
+    switchset.discover_devices()
+    set_switchlist(switchset)
+    all_ports = switchlist.execute_on_all_cached(CiscoTelnetSession.get_interface_status_and_setting)
     all_ports_sorted = sorted(all_ports, key=lambda k: fix_patchid(k['patchid']))
     return all_ports_sorted
 
 
 def get_health_status(hostname, port, username, password):
-    global switchlist
     """ Get a list of the health status for each switch """
     if switchlist is None:
-        switchlist = CiscoSet(username, password, hostname, port)
-        switchlist.discover_devices()
+        switchset = CiscoSet(username, password, hostname, port)
+        switchset.discover_devices()
+        set_switchlist(switchset)
 
     health_status = switchlist.execute_on_all(CiscoTelnetSession.show_health)
     return health_status
@@ -94,8 +153,6 @@ def get_health_status(hostname, port, username, password):
 
 def get_available_vlans(hostname, port, username, password):
     """ Get all available VLANs """
-    dynamic_vlan = {'vlanname': 'dynamic', 'vlanid': 'dynamic', 'status': 'software-generated'}
-    trunk_vlan = {'vlanname': 'trunk', 'vlanid': 'trunk', 'status': 'software-generated'}
     try:
         session = connect_to_switch(hostname, port, username, password)
         vlans = session.show_vlan()
@@ -114,8 +171,11 @@ def get_available_vlannames(hostname, port, username, password):
 
 
 def vlanname_to_vlanid(switch_hostname, port, username, password, vlanname):
-    """ Convert a VLAN name to a VLAN id """
-    vlans = get_available_vlans(switch_hostname, port, username, password)
+    """ Convert a VLAN name to a VLAN id, using the cached VLANs of the switch """
+    switchset = get_switchlist(switch_hostname, port, username, password)
+    vlans = switchset.execute_on_hosts_cached([switch_hostname], CiscoTelnetSession.show_vlan)
+    vlans.append(dynamic_vlan)
+    vlans.append(trunk_vlan)
     for vlan in vlans:
         cur_vlanid = vlan["vlanid"]
         cur_vlanname = vlan["vlanname"]
@@ -125,12 +185,24 @@ def vlanname_to_vlanid(switch_hostname, port, username, password, vlanname):
 
 
 def get_port_from_patchid(hostname, port, username, password, patchid):
-    """ Translate a patchid to a switchport """
+    """ Translate a patchid to a switchport. Looks the patchid up in the ports found by the last discovery
+        and checks only that switch. The network is only rediscovered when the patchid is unknown or moved. """
+    switchset = get_switchlist(hostname, port, username, password)
+    patchport = build_patchid_index(get_cached_patchports(switchset)).get(fix_patchid(patchid))
+    if patchport is not None:
+        current = verify_patchport(switchset, patchport)
+        if current is not None:
+            return current
+
+    # Unknown or moved: the cached ports are out of date, so ask all switches again instead of the cache
+    for host in switchset.seen:
+        switchset.cache.invalidate(host, "get_interface_status_and_setting")
+    switchset.save()  # get_available_patchports starts from the saved cache
     patches = get_available_patchports(hostname, port, username, password)
-    for row in patches:
-        if fix_patchid(row["patchid"]) == fix_patchid(patchid):
-            return row
-    return None
+    patchport = build_patchid_index(patches).get(fix_patchid(patchid))
+    if patchport is None:
+        return None
+    return verify_patchport(switchlist, patchport)
 
 
 def configure_patchid_raw(username, password, switch_hostname, switchport, vlanid, old_vlanid):  # pylint: disable=too-many-arguments
@@ -145,13 +217,84 @@ def configure_patchid_raw(username, password, switch_hostname, switchport, vlani
         print session.set_interface_trunk(switchport)
     print "...Saving configuration to nvram"
     session.save_config()
+    if switchlist is not None:
+        # The cached state of this switch is outdated now
+        switchlist.cache.invalidate(switch_hostname)
+        switchlist.save()
     print "Done"
 
 
+def configure_switch_raw(username, password, switch_hostname, jobs):
+    """ Perform the raw actions needed to configure a number of switchports on a single switch. Returns whether
+        the switchports were set and the configuration was saved. """
+    print "Going to configure %d switchports of switch %s..." % (len(jobs), switch_hostname)
+    for job in jobs:
+        print "...switchport %s to vlanid %s (previously %s)" % (job['switch_port'], job['new_vlan_id'], job['old_vlan_id'])
+    print "...Connecting to switch %s" % switch_hostname
+    session = CiscoTelnetSession()
+    try:
+        if not session.open(switch_hostname, telnet_port, username, password):
+            sys.stderr.write("Error connecting to: " + switch_hostname + ":" + str(telnet_port) + "\n")
+            return False
+        print "...Setting switchports of %s..." % switch_hostname
+        interfaces_vlans = dict((job['switch_port'], job['new_vlan_id']) for job in jobs)
+        print '"' + session.set_interfaces_vlans(interfaces_vlans) + '"'
+        print "...Saving configuration of %s to nvram" % switch_hostname
+        session.save_config()
+    except (EOFError, socket.error) as error:
+        sys.stderr.write("Error configuring %s: %s\n" % (switch_hostname, error))
+        return False
+    finally:
+        if session.session:
+            session.session.close()
+    print "Done with %s" % switch_hostname
+    return True
+
+
+def configure_patchids_raw(username, password, jobs):
+    """ Perform the raw actions for a list of jobs, as used by SetConfigurationThread. Every switch is
+        configured in a single session and saved once, all switches in parallel. Returns a dict of switch
+        hostname -> whether its jobs were applied. """
+    jobs_per_switch = {}
+    for job in jobs:
+        jobs_per_switch.setdefault(job['switch_host'], []).append(job)
+
+    results = {}
+
+    def configure(switch_hostname, switch_jobs):
+        """ Configure a single switch and remember whether it succeeded """
+        try:
+            results[switch_hostname] = configure_switch_raw(username, password, switch_hostname, switch_jobs)
+        except Exception as error:  # pylint: disable=broad-except
+            sys.stderr.write("Error configuring %s: %s\n" % (switch_hostname, error))
+            results[switch_hostname] = False
+
+    threads = []
+    for switch_hostname, switch_jobs in jobs_per_switch.iteritems():
+        thread = threading.Thread(target=configure, args=(switch_hostname, switch_jobs))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    if switchlist is not None:
+        # The cached state of these switches is outdated now, also of those that failed halfway
+        for switch_hostname in jobs_per_switch:
+            switchlist.cache.invalidate(switch_hostname)
+        switchlist.save()
+    return results
+
+
 def configure_patchid(username, password, patchid, vlanname):
     """ Configure a patchid """
     port = get_port_from_patchid(default_switch, telnet_port, username, password, patchid)
+    if port is None:
+        sys.stderr.write("Unknown patchid: " + patchid + "\n")
+        return
     vlanid = vlanname_to_vlanid(default_switch, telnet_port, username, password, vlanname)
+    if vlanid is None:
+        sys.stderr.write("Unknown VLAN: " + vlanname + "\n")
+        return
     switch_hostname = port["hostname"]
     switchport = port["interface"]
     old_vlanid = port["vlanid"]
@@ -205,4 +348,5 @@ if __name__ == '__main__':
     else:
         sys.stderr.write("AIEEE! This should never happen!\n")
 
+    set_switchlist(None)
     sys.exit(0)
@@ -2,6 +2,7 @@
 """ This file is the main routine for finding IPs in a Cisco-based network """
 import sys
 import json
+import Queue
 
 from Cisco import CiscoTelnetSession, CiscoSet
 from portconfig import print_list
@@ -25,9 +26,69 @@ def span_session_from_vlan(spanvlan):
 
 
 
-def erase_remote_span_session(switchset, span_session_number):
-    """ Erase a remote span session on a previously established CiscoSet """
-    switchset.execute_on_all(CiscoTelnetSession.clear_remote_span, span_session_number)
+class SpanRegistry(object):
+    """ Keeps track of which switches hold which SPAN sessions, from the show_span results in the topology cache """
+
+    def __init__(self, switchset):
+        self.switchset = switchset
+        self.sessions = {}  # session number -> set of hostnames
+
+    def refresh(self):
+        """ Fill the registry, only asking the switches of which the cached show_span result is stale """
+        self.sessions = {}
+        for row in self.switchset.execute_on_all_cached(CiscoTelnetSession.show_span):
+            self.sessions.setdefault(int(row["monitor_session"]), set()).add(row["hostname"])
+
+    def update(self, hostname, rows):
+        """ Replace what is known about hostname by a fresh show_span result """
+        self.switchset.cache.put(hostname, "show_span", rows)
+        for hostnames in self.sessions.values():
+            hostnames.discard(hostname)
+        for row in rows:
+            self.sessions.setdefault(int(row["monitor_session"]), set()).add(hostname)
+
+    def hosts(self, span_session_number):
+        """ Return the switches holding session span_session_number """
+        return self.sessions.get(span_session_number, set())
+
+    def rows(self):
+        """ Return the cached show_span results of all switches """
+        return self.switchset.execute_on_all_cached(CiscoTelnetSession.show_span)
+
+
+def execute_in_parallel(switchset, calls):
+    """ Execute a list of (host, command name, args) on their devices at the same time. Returns the hosts that
+        failed. """
+    finished = Queue.Queue()
+    done = lambda host, result, error: finished.put((host, error))
+    for host, command_name, args in calls:
+        switchset.execute_on_host_async(host, command_name, done, *args)
+    failed = []
+    for _ in calls:
+        host, error = finished.get()
+        if error is not None:
+            sys.stderr.write("%s failed: %s\n" % (host, error[1]))
+            failed.append(host)
+    return failed
+
+
+def verify_span(switchset, registry, hosts):
+    """ Ask hosts for their SPAN sessions again, and update the registry """
+    for host, rows, error in switchset.iter_on_hosts(hosts, CiscoTelnetSession.show_span):
+        if error is None:
+            registry.update(host, rows)
+    switchset.save()
+
+
+def erase_remote_span_session(switchset, span_session_number, registry=None, extra_hosts=()):
+    """ Erase a remote span session on a previously established CiscoSet. Only touches the switches holding the
+        session according to the registry, plus extra_hosts. """
+    if registry is None:
+        registry = SpanRegistry(switchset)
+        registry.refresh()
+    hosts = sorted(registry.hosts(span_session_number) | set(extra_hosts))
+    execute_in_parallel(switchset, [(host, "clear_remote_span", (span_session_number,)) for host in hosts])
+    return hosts
 
 
 
@@ -36,25 +97,35 @@ def discover_erase_span(user, pwd, switch, spansession):
 	span_session_number = int(spansession)
 	switchset = CiscoSet(user, pwd, switch, telnet_port)
 	switchset.discover_devices()
-	erase_remote_span_session(switchset, span_session_number)
-	output = switchset.execute_on_all(CiscoTelnetSession.show_span)
-	json_output = json.dumps(output)
+	registry = SpanRegistry(switchset)
+	registry.refresh()
+	touched = erase_remote_span_session(switchset, span_session_number, registry)
+	verify_span(switchset, registry, touched)
+	json_output = json.dumps(registry.rows())
 	print json_output
+	switchset.close()
 
 
 def list_span_sessions(user, pwd, switch):
     """ Show all current span sessions """
     switchset = CiscoSet(user, pwd, switch, telnet_port)
     switchset.discover_devices()
-    output = switchset.execute_on_all(CiscoTelnetSession.show_span)
+    output = []
+    for host, rows, error in switchset.iter_on_all(CiscoTelnetSession.show_span):
+        if error is None:
+            switchset.cache.put(host, "show_span", rows)  # Only switches that answered, the others are asked again
+            output.extend(rows)
+        else:
+            sys.stderr.write("%s failed: %s\n" % (host, error[1]))
+    switchset.save()
     json_output = json.dumps(output)
     print json_output
+    switchset.close()
 
 
 
 def configure_remote_span(srcswitch, srcport, srcinterface, dstswitch, dstinterface, spanvlan, user, pwd): #pylint: disable=too-many-arguments
 	"""Configure a remote span session on both switches"""
-	dstport = srcport
 	switchset = CiscoSet(user, pwd, srcswitch, srcport)
 	span_session_number = spanvlan
 
@@ -62,25 +133,20 @@ def configure_remote_span(srcswitch, srcport, srcinterface, dstswitch, dstinterf
 	switchset.discover_devices()
 
 	#print "Removing all references to Remote SPAN session %d on vlan %d" % (span_session_number, span_vlan)
-	erase_remote_span_session(switchset, span_session_number)
+	registry = SpanRegistry(switchset)
+	registry.refresh()
+	erase_remote_span_session(switchset, span_session_number, registry, [srcswitch, dstswitch])
 	if srcswitch == dstswitch: # No Remote needed on the same switch.
-		source = CiscoTelnetSession()
-		source.open(srcswitch, srcport, user, pwd)
-		source.remote_span(span_session_number, "interface " + srcinterface, "interface " + dstinterface)
+		calls = [(srcswitch, "remote_span", (span_session_number, "interface " + srcinterface, "interface " + dstinterface))]
 	else:
-		#print "Setting source switch " + srcswitch
-		source = CiscoTelnetSession()
-		source.open(srcswitch, srcport, user, pwd)
-		source.remote_span(span_session_number, "interface " + srcinterface, "remote vlan " + str(spanvlan))
-
-		#print "Setting destination switch " + dstswitch
-		dest = CiscoTelnetSession()
-		dest.open(dstswitch, dstport, user, pwd)
-		dest.remote_span(span_session_number, "remote vlan " + str(spanvlan), "interface " + dstinterface)
-
-	output = switchset.execute_on_all(CiscoTelnetSession.show_span)
-	json_output = json.dumps(output)
+		calls = [(srcswitch, "remote_span", (span_session_number, "interface " + srcinterface, "remote vlan " + str(spanvlan)))]
+		calls.append((dstswitch, "remote_span", (span_session_number, "remote vlan " + str(spanvlan), "interface " + dstinterface)))
+	execute_in_parallel(switchset, calls)
+
+	verify_span(switchset, registry, registry.hosts(span_session_number) | set([srcswitch, dstswitch]))
+	json_output = json.dumps(registry.rows())
 	print json_output
+	switchset.close()
 
 
 if __name__ == '__main__':
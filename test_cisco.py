@@ -0,0 +1,142 @@
+#/usr/bin/env python
+#
+# Copyright (C) 2016-2017 DNW German-Dutch Wind Tunnels
+#
+# This file is part of nettools.
+# Nettools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with nettools.  If not, see <http://www.gnu.org/licenses/>.
+""" Tests for the Cisco module, run against a local fake IOS server """
+
+import threading
+import unittest
+
+from Cisco import SessionPool, CiscoTelnetSession, execute_on_pooled_device, stream_on_pooled_device
+from fake_ios import start_fake_ios, mac_address_table_output
+
+
+class SessionPoolTest(unittest.TestCase):
+    """ Tests for SessionPool """
+
+    def setUp(self):
+        self.server = start_fake_ios("switch01")
+        self.pool = SessionPool(self.server.server_address[1], self.server.username, self.server.password)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def acquire_in_thread(self, hostname, timeout=5):
+        """ Call acquire on a separate thread, so a hanging acquire fails the test instead of blocking it """
+        result = []
+        thread = threading.Thread(target=lambda: result.append(self.pool.acquire(hostname)))
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        self.assertFalse(thread.is_alive(), "acquire(%s) did not return" % hostname)
+        return result[0]
+
+    def test_hang_up_during_login(self):
+        """ A device that closes the connection right away gives None, and doesn't keep its slot """
+        self.server.hang_up = True
+        self.assertIsNone(self.acquire_in_thread("127.0.0.1"))
+        self.assertEqual(self.pool.in_use["127.0.0.1"], 0)
+        self.assertIsNone(self.acquire_in_thread("127.0.0.1"))
+
+        self.server.hang_up = False
+        session = self.acquire_in_thread("127.0.0.1")
+        self.assertIsNotNone(session)
+        self.pool.release("127.0.0.1", session)
+
+    def test_free_form_commands_close_the_session(self):
+        """ Sessions used for free-form commands, which can change their mode, aren't handed out again """
+        execute_on_pooled_device(self.pool, "127.0.0.1", "execute_command", "conf t")
+        self.assertEqual(self.pool.idle.get("127.0.0.1", []), [])
+        self.assertEqual(self.pool.in_use["127.0.0.1"], 0)
+
+        execute_on_pooled_device(self.pool, "127.0.0.1", "show_vlan")
+        self.assertEqual(len(self.pool.idle["127.0.0.1"]), 1)
+
+    def test_timed_out_read_closes_the_session(self):
+        """ A session that timed out waiting for the prompt still has output on its way, and isn't handed out again """
+        execute_on_pooled_device(self.pool, "127.0.0.1", "show_vlan")
+        self.pool.idle["127.0.0.1"][0][0].response_timeout = 0.2
+        self.server.latency = 1
+        execute_on_pooled_device(self.pool, "127.0.0.1", "show_vlan")
+        self.assertEqual(self.pool.idle.get("127.0.0.1", []), [])
+        self.assertEqual(self.pool.in_use["127.0.0.1"], 0)
+
+    def test_streamed_rows(self):
+        """ A streamed command yields the same rows as the buffered one, and keeps its session until it is done """
+        self.server.outputs["show mac address-table"] = mac_address_table_output(
+            [("10", "0050.0000.%04x" % port, "Gi1/0/%d" % port) for port in range(1, 1001)])
+        rows = stream_on_pooled_device(self.pool, "127.0.0.1", "stream_mac_address_table")
+        self.assertEqual(next(rows)["macaddress"], "0050.0000.0001")
+        self.assertEqual(self.pool.in_use["127.0.0.1"], 1)
+        self.assertEqual(len(list(rows)), 999)
+        self.assertEqual(self.pool.in_use["127.0.0.1"], 0)
+        self.assertEqual(len(self.pool.idle["127.0.0.1"]), 1)
+
+        self.assertEqual(list(stream_on_pooled_device(self.pool, "127.0.0.1", "stream_mac_address_table")),
+                         execute_on_pooled_device(self.pool, "127.0.0.1", "show_mac_address_table"))
+
+    def test_stream_stopped_early(self):
+        """ A session whose rows weren't all consumed still has output on its way, and isn't handed out again """
+        self.server.outputs["show mac address-table"] = mac_address_table_output(
+            [("10", "0050.0000.%04x" % port, "Gi1/0/%d" % port) for port in range(1, 1001)])
+        rows = stream_on_pooled_device(self.pool, "127.0.0.1", "stream_mac_address_table")
+        next(rows)
+        rows.close()
+        self.assertEqual(self.pool.in_use["127.0.0.1"], 0)
+        self.assertEqual(self.pool.idle.get("127.0.0.1", []), [])
+
+
+class WriteCommandTest(unittest.TestCase):
+    """ Tests for CiscoTelnetSession.write_command """
+
+    def setUp(self):
+        self.server = start_fake_ios("switch01")
+        self.session = CiscoTelnetSession()
+        self.session.echo_timeout_seconds = 0.5
+        self.session.character_time_spacing_seconds = 0.01
+        self.session.line_time_spacing_seconds = 0.01
+        self.assertTrue(self.session.open("127.0.0.1", self.server.server_address[1],
+                                          self.server.username, self.server.password))
+        CiscoTelnetSession.echo_failures.clear()
+        CiscoTelnetSession.character_paced_hosts.discard("127.0.0.1")
+
+    def tearDown(self):
+        self.session.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_dropped_line_is_written_again(self):
+        """ A line the device drops part of is written again, before the lines following it """
+        self.server.max_burst = 12
+        self.session.execute_command("config t\ninterface Gi1/0/1\nswitchport access vlan 10\nend")
+        self.assertEqual(self.server.config_lines, ["interface Gi1/0/1", "switchport access vlan 10", "end"])
+        self.assertTrue(self.session.character_paced)
+        self.assertNotIn("127.0.0.1", CiscoTelnetSession.character_paced_hosts)  # A single failure only paces the session
+
+    def test_character_paced_command_waits_for_all_lines(self):
+        """ A device lagging behind character paced input doesn't end a command at the prompt after an earlier line """
+        self.session.character_paced = True
+        self.server.echo_delay = 0.02
+        output = self.session.execute_command("config t\ninterface Gi1/0/1\nend")
+        self.assertTrue(output.rstrip().endswith("end"), output)
+        self.server.echo_delay = 0.0
+        self.assertTrue(self.session.execute_command("show vlan brief").startswith("show vlan brief"))
+
+
+if __name__ == '__main__':
+    unittest.main()
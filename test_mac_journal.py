@@ -0,0 +1,95 @@
+#/usr/bin/env python
+#
+# Copyright (C) 2016-2017 DNW German-Dutch Wind Tunnels
+#
+# This file is part of nettools.
+# Nettools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with nettools.  If not, see <http://www.gnu.org/licenses/>.
+""" Tests for the mac_journal module """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mac_journal import MacJournal, read_journal
+
+mac1 = "0050.0000.0001"
+mac2 = "0050.0000.0002"
+
+
+def mac_entry(macaddress, hostname, port, vlanid="10"):
+    """ Produce a row of show_mac_address_table """
+    return {"macaddress": macaddress, "vlanid": vlanid, "hostname": hostname, "port": port}
+
+
+class MacJournalTest(unittest.TestCase):
+    """ Tests for MacJournal and read_journal """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "macJournal.tsv")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_diff(self):
+        """ Added, moved and removed entries are reported once, ports only seen in ARP keep their port """
+        journal = MacJournal(self.filename)
+        added = journal.diff({(mac1, "10"): ("switch01", "Gi1/0/1", ""), (mac2, "10"): ("switch01", "Gi1/0/2", "")}, 0)
+        self.assertEqual(added, [("added", (mac1, "10"), ("switch01", "Gi1/0/1", "")),
+                                 ("added", (mac2, "10"), ("switch01", "Gi1/0/2", ""))])
+        self.assertEqual(journal.diff({(mac1, "10"): ("switch01", "Gi1/0/1", ""),
+                                       (mac2, "10"): ("switch01", "Gi1/0/2", "")}, 60), [])
+
+        moved = journal.diff({(mac1, "10"): ("switch02", "Gi1/0/7", ""), (mac2, "10"): ("", "", "10.0.0.2")}, 120)
+        self.assertEqual(moved, [("moved", (mac1, "10"), ("switch02", "Gi1/0/7", "")),
+                                 ("moved", (mac2, "10"), ("switch01", "Gi1/0/2", "10.0.0.2"))])
+
+        self.assertEqual(journal.diff({}, 120 + journal.removal_delay), [])  # Not missing for long enough yet
+        removed = journal.diff({}, 121 + journal.removal_delay)
+        self.assertEqual(removed, [("removed", (mac1, "10"), ("switch02", "Gi1/0/7", "")),
+                                   ("removed", (mac2, "10"), ("switch01", "Gi1/0/2", "10.0.0.2"))])
+
+    def test_update_and_load(self):
+        """ Changes are appended to the journal, and the locations survive a restart """
+        journal = MacJournal(self.filename)
+        journal.update([mac_entry(mac1, "switch01", "Gi1/0/1")], [], 100)
+
+        journal = MacJournal(self.filename)
+        self.assertTrue(journal.load())
+        self.assertEqual(journal.update([mac_entry(mac1, "switch01", "Gi1/0/1")], [], 200), [])
+        journal.update([mac_entry(mac1, "switch02", "Gi1/0/7")], [], 300)
+        self.assertEqual([(change["time"], change["event"], change["hostname"]) for change in read_journal(self.filename)],
+                         [(100, "added", "switch01"), (300, "moved", "switch02")])
+
+    def test_read_journal_since(self):
+        """ The changes since a time start with where the mac address was at that time """
+        journal = MacJournal(self.filename)
+        journal.update([mac_entry(mac1, "switch01", "Gi1/0/1"), mac_entry(mac2, "switch01", "Gi1/0/2")], [], 100)
+        journal.update([mac_entry(mac1, "switch01", "Gi1/0/1"), mac_entry(mac2, "switch02", "Gi1/0/2")], [], 200)
+
+        changes = list(read_journal(self.filename, mac1, 150))
+        self.assertEqual([(change["time"], change["event"], change["port"]) for change in changes],
+                         [(100, "added", "Gi1/0/1")])
+
+        changes = list(read_journal(self.filename, mac2, 150))
+        self.assertEqual([(change["time"], change["event"], change["hostname"]) for change in changes],
+                         [(100, "added", "switch01"), (200, "moved", "switch02")])
+
+        self.assertEqual([change["time"] for change in read_journal(self.filename, mac2, 250)], [200])
+        self.assertEqual(list(read_journal(self.filename, "0050.0000.0003", 150)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
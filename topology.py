@@ -0,0 +1,123 @@
+#/usr/bin/env python
+#
+# Copyright (C) 2016-2017 DNW German-Dutch Wind Tunnels
+#
+# This file is part of nettools.
+# Nettools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Nettools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with nettools.  If not, see <http://www.gnu.org/licenses/>.
+""" This module defines the TopologyCache class, a local store of per-device command results """
+
+import json
+import time
+import threading
+
+from atomic_file import write_atomic
+
+
+class TopologyCache(object):
+    """ A versioned, file backed store of command results per device, each with a fetch time and a TTL """
+
+    version = 2  # 2: interface names are normalized
+
+    # Seconds a result stays fresh, keyed by CiscoTelnetSession method name
+    default_ttl = {
+        "show_neighbors": 24 * 3600,
+        "show_vlan": 3600,
+        "show_span": 3600,
+        "show_interface_vlan": 600,
+        "get_interface_vlan_setting": 600,
+        "get_interface_status_and_setting": 600,
+        "show_mac_address_table": 300,
+        "show_arp": 300,
+    }
+    fallback_ttl = 300
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.devices = {}  # hostname -> command name -> {"fetched": time, "ttl": seconds, "data": result}
+        self.seen = []
+        self.adjacency = []
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # Keeps saves from different threads in order
+
+    @staticmethod
+    def copy_data(data):
+        """ Copy a command result, so callers can modify the rows without changing the cache """
+        if isinstance(data, list):
+            return [dict(row) if isinstance(row, dict) else row for row in data]
+        return data
+
+    def load(self):
+        """ Load from file, return whether a usable cache was found """
+        try:
+            with open(self.filename, "r") as fd:
+                json_decoded = json.load(fd)
+        except (IOError, ValueError):
+            return False
+
+        if not isinstance(json_decoded, dict) or json_decoded.get("version") != self.version:
+            return False  # Written by an incompatible version, start over
+
+        with self.lock:
+            self.devices = json_decoded.get("devices", {})
+            self.seen = json_decoded.get("seen", [])
+            self.adjacency = json_decoded.get("adjacency", [])
+        return True
+
+    def save(self):
+        """ Save to file, see write_atomic. Saves are serialized, so an older cache can't replace a newer one. """
+        with self.save_lock:
+            with self.lock:
+                json_contents = json.dumps({
+                    "version": self.version,
+                    "seen": self.seen,
+                    "adjacency": self.adjacency,
+                    "devices": self.devices})
+            write_atomic(self.filename, json_contents)
+
+    def put(self, hostname, command_name, data, ttl=None):
+        """ Store the result of command_name on hostname """
+        if ttl is None:
+            ttl = self.default_ttl.get(command_name, self.fallback_ttl)
+        record = {"fetched": time.time(), "ttl": ttl, "data": self.copy_data(data)}
+        with self.lock:
+            self.devices.setdefault(hostname, {})[command_name] = record
+
+    def invalidate(self, hostname, command_name=None):
+        """ Forget the result of command_name on hostname, or all results of hostname """
+        with self.lock:
+            if command_name is None:
+                self.devices.pop(hostname, None)
+            else:
+                self.devices.get(hostname, {}).pop(command_name, None)
+
+    def get(self, hostname, command_name):
+        """ Get the cached result of command_name on hostname, regardless of its age, or None """
+        with self.lock:
+            record = self.devices.get(hostname, {}).get(command_name)
+        if record is None:
+            return None
+        return self.copy_data(record["data"])
+
+    def is_stale(self, hostname, command_name, now=None):
+        """ Return whether the result of command_name on hostname is missing or older than its TTL """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            record = self.devices.get(hostname, {}).get(command_name)
+        return record is None or now - record["fetched"] > record["ttl"]
+
+    def stale_hosts(self, hostnames, command_name):
+        """ Return the hosts of which the result of command_name needs to be refreshed """
+        now = time.time()
+        return [hostname for hostname in hostnames if self.is_stale(hostname, command_name, now)]
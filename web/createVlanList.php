@@ -5,8 +5,9 @@ define("SWITCH_PASSWORD", "SWITCH_PASSWORD");
 define("ROUTER_NAME", "ROUTER_NAME");
 define("SWITCH_NAME", "SWITCH_NAME");
 
+$local = true;
 if(is_file("src/networkOverview.json"))
-    $networkOverview = file_get_contents("src/networkOverview.json");
+    $networkOverview = file_get_contents("src/networkOverview.json"); // Written by network_overview.py in snapshot mode
 else{
     // This is not recommended as it might place a heay load on the switches. Try and use the local file above if possible
     $local = false;
@@ -8,38 +8,48 @@ define("SWITCH_NAME", "SWITCH_NAME");
 if(!isset($_POST['ip_lookup']) || $_POST['ip_lookup'] == "")
     exit("No data sent");
 
+$ip = $_POST['ip_lookup'];
 if(inet_pton($ip) === false) { //Not an IP-adres, try for hostname
     $ip = gethostbyname($ip);
     if(inet_pton($ip) === false)
         exit("Not a valid IP-address, and hostname not found");
 }
 
-if(is_file("src/networkOverview.json"))
-    $networkOverview = file_get_contents("src/networkOverview.json");
-else{
-    // This is not recommended as it might place a heay load on the switches. Try and use the local file above if possible
-    $local = false;
-    $networkOverview = shell_exec("python ../network_overview.py " . SWITCH_USERNAME . " " . SWITCH_PASSWORD . " " . ROUTER_NAME . " " . SWITCH_NAME );
+$local = true;
+if(is_dir("src/lookup")) {
+    // Written by network_overview.py in snapshot mode: one small file per IP
+    $results = [];
+    if(is_file("src/lookup/ip/" . $ip . ".json"))
+        $results = json_decode(file_get_contents("src/lookup/ip/" . $ip . ".json"))->mac;
 }
+else {
+    if(is_file("src/networkOverview.json"))
+        $networkOverview = file_get_contents("src/networkOverview.json");
+    else{
+        // This is not recommended as it might place a heay load on the switches. Try and use the local file above if possible
+        $local = false;
+        $networkOverview = shell_exec("python ../network_overview.py " . SWITCH_USERNAME . " " . SWITCH_PASSWORD . " " . ROUTER_NAME . " " . SWITCH_NAME );
+    }
 
-$networkOverview = json_decode($networkOverview);
+    $networkOverview = json_decode($networkOverview);
 
-$arp = $networkOverview->arp;
-$mac = $networkOverview->mac;
-$allPorts = $networkOverview->ports;
+    $arp = $networkOverview->arp;
+    $mac = $networkOverview->mac;
+    $allPorts = $networkOverview->ports;
 
-$ip_mac = "0000.0000.0000";
-foreach($arp as $arp_entry) {
-    $arp_entry_ip = $arp_entry->ip;
-    $arp_entry_mac = $arp_entry->macaddress;
-    if($arp_entry_ip == $ip)
-        $ip_mac = $arp_entry_mac;
-}
+    $ip_mac = "0000.0000.0000";
+    foreach($arp as $arp_entry) {
+        $arp_entry_ip = $arp_entry->ip;
+        $arp_entry_mac = $arp_entry->macaddress;
+        if($arp_entry_ip == $ip)
+            $ip_mac = $arp_entry_mac;
+    }
 
-$results = [];
-foreach($mac as $mac_entry) {
-    if ($mac_entry->macaddress == $ip_mac) {
-        $results[]=$mac_entry;
+    $results = [];
+    foreach($mac as $mac_entry) {
+        if ($mac_entry->macaddress == $ip_mac) {
+            $results[]=$mac_entry;
+        }
     }
 }
 